@@ -0,0 +1,128 @@
+"""
+Measure the throughput of concurrent imports under each locking mode, in a throwaway PostgreSQL server.
+
+The server and synthetic data are those of `import_hot_paths.py`.
+For each of `nfldbproj.update.LOCKING_MODES`, `--workers` threads, each with its own connection,
+start together and call `nfldbproj.update.insert_dataframe` for every week of the last season,
+each writing the projections of its own source (starting from a different week).
+With `'table'` locking the imports take turns; with `'advisory'` locking they only wait for each other
+to refresh the consensus of the same week.
+The report gives the rows written per second by all workers together,
+and the total time the workers spent waiting for the locks of `lock_tables` or `lock_data`.
+
+`initdb` refuses to run as root.
+
+Usage: python benchmarks/concurrent_imports.py [--workers 4] [--rounds 1] [--seasons 1] [--depth 1]
+                                               [--seed 0] [--pg-bin DIR] [--keep]
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import threading
+import time
+import traceback
+from collections import namedtuple
+
+import nfldbproj
+from nfldbproj import import_, instrument, update
+
+from import_hot_paths import throwaway_server, generate, _metadata
+
+Result = namedtuple('Result', ['locking', 'workers', 'rows', 'seconds', 'lock_wait'])
+
+
+def prepare(db, export):
+    """
+    Return the last season of `export` and its weeks, with game and player ids assigned,
+    as a list of `(week, df)` pairs.
+
+    """
+    season_year = int(export['season_year'].max())
+    df = export[export['season_year'] == season_year].drop('season_year', axis=1).copy()
+    import_.assign_gsis_ids(db, df, _metadata('prepare', season_year))
+    import_.fix_dst_names(df)
+    import_.assign_player_ids(db, df)
+    return season_year, [(int(week), week_df.drop(['name', 'opp'], axis=1)) for week, week_df in df.groupby('week')]
+
+
+def run(connections, season_year, weeks, locking, source_prefix):
+    """
+    Import every week of `weeks` on each connection of `connections` concurrently,
+    each as its own source, returning a `Result`.
+
+    """
+    barrier = threading.Barrier(len(connections) + 1)
+    failures = []
+
+    def work(i, db):
+        order = weeks[i % len(weeks):] + weeks[:i % len(weeks)]
+        barrier.wait()
+        try:
+            for week, df in order:
+                metadata = dict(_metadata('{}_{}'.format(source_prefix, i), season_year), week=week)
+                update.insert_dataframe(db, metadata, df, locking=locking)
+        except Exception:
+            failures.append(traceback.format_exc())
+
+    threads = [threading.Thread(target=work, args=(i, db), name='worker-{}'.format(i))
+               for i, db in enumerate(connections)]
+    for thread in threads:
+        thread.start()
+    with instrument.recording() as recorder:
+        barrier.wait()
+        start = time.time()
+        for thread in threads:
+            thread.join()
+        seconds = time.time() - start
+    if failures:
+        raise RuntimeError('{} workers failed:\n{}'.format(len(failures), '\n'.join(failures)))
+
+    lock_wait = sum(total['lock_wait'] for (stage, _), total in recorder.totals().items()
+                    if stage in ('lock_tables', 'lock_data'))
+    rows = len(connections) * sum(len(df) for _, df in weeks)
+    return Result(locking, len(connections), rows, seconds, lock_wait)
+
+
+def report(results):
+    print('\n{:10} {:>8} {:>8} {:>9} {:>10} {:>15}'.format(
+        'locking', 'workers', 'rows', 'seconds', 'rows/s', 'lock wait (s)'
+    ))
+    for result in results:
+        print('{:10} {:8d} {:8d} {:9.3f} {:10.0f} {:15.3f}'.format(
+            result.locking, result.workers, result.rows, result.seconds,
+            result.rows / max(result.seconds, 1e-9), result.lock_wait,
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', type=int, default=4, help='concurrent imports')
+    parser.add_argument('--rounds', type=int, default=1, help='runs of each locking mode')
+    parser.add_argument('--seasons', type=int, default=1, help='seasons of players and games')
+    parser.add_argument('--depth', type=int, default=1, help='multiplier of the players per team')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pg-bin', help='directory containing initdb and pg_ctl')
+    parser.add_argument('--keep', action='store_true', help="don't delete the server's files")
+    args = parser.parse_args()
+
+    results = []
+    with throwaway_server(args.pg_bin, args.keep) as connect_args:
+        connections = [nfldbproj.connect(**connect_args) for _ in range(args.workers)]
+        try:
+            export = generate(connections[0], args.seasons, args.depth, args.seed)
+            season_year, weeks = prepare(connections[0], export)
+            # Create the partitions and load the schema catalog before timing.
+            update.insert_dataframe(connections[0], dict(_metadata('warmup', season_year), week=weeks[0][0]),
+                                    weeks[0][1])
+            for i in range(args.rounds):
+                for locking in update.LOCKING_MODES:
+                    results.append(run(connections, season_year, weeks, locking, 'bench_{}_{}'.format(locking, i)))
+        finally:
+            for conn in connections:
+                conn.close()
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
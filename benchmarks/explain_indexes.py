@@ -0,0 +1,203 @@
+"""
+Compare query plans for the nfldbproj lookup paths with and without
+the indexes added in schema version 3.
+
+Synthetic projections, scores and salaries are generated for the real games and players
+of the most recent seasons in the database, then each lookup query is run with
+EXPLAIN ANALYZE twice: once with the version 3 indexes dropped and once with them in place.
+Plans name the partitions they scan, so the projection queries show whether other seasons are pruned.
+Everything runs in a single transaction that is rolled back,
+but the tables involved are locked while it runs, so use a development database.
+
+Usage: python benchmarks/explain_indexes.py [--seasons 3] [--sources 5] [--scrapes 3]
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+
+from psycopg2.extras import RealDictCursor
+
+import nfldbproj
+from nfldbproj.db import nfldbproj_partitioned_tables, _access_path_indexes, _create_partition
+
+FPSYS = 'bench_fpsys'
+DFS = 'bench_dfs'
+
+QUERIES = [
+    ('player history: fp_projection', '''
+        SELECT * FROM fp_projection WHERE fantasy_player_id = %(player)s
+    '''),
+    ('player history: fp_score', '''
+        SELECT * FROM fp_score WHERE fantasy_player_id = %(player)s
+    '''),
+    ('player history: dfs_salary', '''
+        SELECT * FROM dfs_salary WHERE fantasy_player_id = %(player)s
+          ORDER BY season_year DESC, week DESC
+    '''),
+    ('game slate: fp_projection', '''
+        SELECT * FROM fp_projection WHERE gsis_id = %(gsis_id)s
+    '''),
+    ('game slate: fp_score', '''
+        SELECT * FROM fp_score WHERE gsis_id = %(gsis_id)s
+    '''),
+    ('week slate: dfs_salary', '''
+        SELECT * FROM dfs_salary
+          WHERE fpsys_name = %(fpsys)s AND dfs_name = %(dfs)s
+            AND season_year = %(season_year)s AND season_type = %(season_type)s AND week = %(week)s
+    '''),
+    ('latest set per source for a week', '''
+        SELECT DISTINCT ON (source_name) * FROM projection_set
+          WHERE fpsys_name = %(fpsys)s AND season_year = %(season_year)s
+            AND season_type = %(season_type)s AND week = %(week)s
+          ORDER BY source_name, date_accessed DESC, set_id DESC
+    '''),
+    ('latest projections for a week', '''
+        SELECT p.* FROM (
+            SELECT DISTINCT ON (source_name) source_name, fpsys_name, set_id, season_year FROM projection_set
+              WHERE fpsys_name = %(fpsys)s AND season_year = %(season_year)s
+                AND season_type = %(season_type)s AND week = %(week)s
+              ORDER BY source_name, date_accessed DESC, set_id DESC
+        ) AS s
+        JOIN fp_projection AS p USING (source_name, fpsys_name, set_id, season_year)
+        WHERE p.season_year = %(season_year)s
+    '''),
+    ('latest projections for a week (query API)', '''
+        WITH sets AS (
+            SELECT DISTINCT ON (s.source_name, s.fpsys_name, s.season_year, s.season_type, s.week) s.*
+              FROM projection_set AS s
+              WHERE s.fpsys_name = ANY(ARRAY[%(fpsys)s]) AND s.season_year = ANY(ARRAY[%(season_year)s])
+                AND s.season_type = ANY(ARRAY[%(season_type)s]::season_phase[]) AND s.week = ANY(ARRAY[%(week)s])
+              ORDER BY s.source_name, s.fpsys_name, s.season_year, s.season_type, s.week,
+                       s.date_accessed DESC, s.set_id DESC
+        )
+        SELECT p.* FROM sets AS s
+          JOIN fp_projection AS p
+            ON (p.source_name, p.fpsys_name, p.set_id, p.season_year)
+             = (s.source_name, s.fpsys_name, s.set_id, s.season_year)
+          WHERE p.season_year = ANY(ARRAY[%(season_year)s])
+    '''),
+]
+
+
+def generate(c, seasons, sources, scrapes):
+    """Insert synthetic data for the last `seasons` seasons of games in the database."""
+    c.execute('''
+        SELECT max(season_year) - %s + 1 AS first_season FROM game WHERE season_type = 'Regular'
+    ''', (seasons,))
+    first_season = c.fetchone()['first_season']
+    params = {'fpsys': FPSYS, 'dfs': DFS, 'first_season': first_season,
+              'sources': sources, 'scrapes': scrapes}
+
+    c.execute('''
+        INSERT INTO fp_system (fpsys_name) VALUES (%(fpsys)s) ON CONFLICT DO NOTHING;
+        INSERT INTO dfs_site (fpsys_name, dfs_name, dfs_url)
+          VALUES (%(fpsys)s, %(dfs)s, 'http://example.com') ON CONFLICT DO NOTHING;
+        INSERT INTO projection_source (source_name)
+          SELECT 'bench_source_' || i FROM generate_series(1, %(sources)s) AS i
+          ON CONFLICT DO NOTHING;
+    ''', params)
+    c.execute('''
+        CREATE TEMPORARY TABLE bench_appearance ON COMMIT DROP AS
+          SELECT g.gsis_id, g.season_year, g.season_type, g.week, p.player_id, p.team,
+                 p.position::text::fantasy_position AS fantasy_pos
+            FROM game AS g
+            JOIN player AS p ON p.team IN (g.home_team, g.away_team)
+            WHERE g.season_year >= %(first_season)s AND g.season_type = 'Regular'
+              AND p.position::text IN ('QB', 'RB', 'WR', 'TE', 'K')
+    ''', params)
+    c.execute('''
+        INSERT INTO projection_set (source_name, fpsys_name, projection_scope,
+                                    season_year, season_type, week, date_accessed)
+          SELECT 'bench_source_' || i, %(fpsys)s, 'week', w.season_year, w.season_type, w.week,
+                 now() - make_interval(hours => r)
+            FROM (SELECT DISTINCT season_year, season_type, week FROM bench_appearance) AS w,
+                 generate_series(1, %(sources)s) AS i,
+                 generate_series(1, %(scrapes)s) AS r
+    ''', params)
+    c.execute('SELECT DISTINCT season_year FROM bench_appearance')
+    for row in c.fetchall():
+        for table in nfldbproj_partitioned_tables:
+            _create_partition(c, table, row['season_year'])
+    c.execute('''
+        INSERT INTO fp_projection (source_name, fpsys_name, set_id, season_year, fantasy_player_id, gsis_id,
+                                   team, fantasy_pos, projected_fp, fp_variance)
+          SELECT s.source_name, s.fpsys_name, s.set_id, s.season_year, a.player_id, a.gsis_id,
+                 a.team, a.fantasy_pos, random() * 25, random() * 30
+            FROM projection_set AS s
+            JOIN bench_appearance AS a USING (season_year, season_type, week)
+            WHERE s.fpsys_name = %(fpsys)s
+    ''', params)
+    c.execute('''
+        INSERT INTO fp_score (fpsys_name, gsis_id, fantasy_player_id, team, fantasy_pos, actual_fp)
+          SELECT %(fpsys)s, gsis_id, player_id, team, fantasy_pos, random() * 25 FROM bench_appearance
+          ON CONFLICT DO NOTHING;
+        INSERT INTO dfs_salary (fpsys_name, dfs_name, fantasy_player_id, season_year, season_type, week, salary)
+          SELECT %(fpsys)s, %(dfs)s, player_id, season_year, season_type, week, 3000 + (random() * 6000)::int
+            FROM bench_appearance
+          ON CONFLICT DO NOTHING;
+        ANALYZE projection_set, fp_projection, fp_score, dfs_salary;
+    ''', params)
+
+    c.execute('SELECT count(*) AS n FROM fp_projection WHERE fpsys_name = %(fpsys)s', params)
+    print('Generated {} fp_projection rows.'.format(c.fetchone()['n']))
+
+    c.execute('''
+        SELECT gsis_id, player_id AS player, season_year, season_type::text AS season_type, week
+          FROM bench_appearance ORDER BY gsis_id DESC LIMIT 1
+    ''')
+    sample = dict(c.fetchone())
+    sample.update(fpsys=FPSYS, dfs=DFS)
+    return sample
+
+
+def explain(c, params):
+    """Return a dictionary mapping query names to (plan node types, execution time in ms)."""
+    results = {}
+    for name, query in QUERIES:
+        c.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + query, params)
+        plan = c.fetchone()['QUERY PLAN'][0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)[0]
+        results[name] = (_node_types(plan['Plan']), plan['Execution Time'])
+    return results
+
+
+def _node_types(node):
+    types = [node['Node Type'] + ''.join(' {} {}'.format(preposition, node[key]) for preposition, key in [
+        ('of', 'Relation Name'), ('on', 'Index Name'),
+    ] if key in node)]
+    for child in node.get('Plans', []):
+        types.extend(_node_types(child))
+    return types
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seasons', type=int, default=3)
+    parser.add_argument('--sources', type=int, default=5)
+    parser.add_argument('--scrapes', type=int, default=3, help='projection sets per source per week')
+    args = parser.parse_args()
+
+    db = nfldbproj.connect()
+    c = db.cursor(cursor_factory=RealDictCursor)
+    try:
+        params = generate(c, args.seasons, args.sources, args.scrapes)
+
+        c.execute('SAVEPOINT without_indexes')
+        c.execute('DROP INDEX {}'.format(', '.join(name for name, _, _ in _access_path_indexes)))
+        before = explain(c, params)
+        c.execute('ROLLBACK TO SAVEPOINT without_indexes')
+        after = explain(c, params)
+    finally:
+        db.rollback()
+
+    for name, _ in QUERIES:
+        print('\n{}: {:.2f} ms -> {:.2f} ms'.format(name, before[name][1], after[name][1]))
+        print('  before: {}'.format(', '.join(before[name][0])))
+        print('  after:  {}'.format(', '.join(after[name][0])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,443 @@
+"""
+Measure the import hot paths on synthetic data in a throwaway PostgreSQL server.
+
+A server is initialized in a temporary directory with `initdb`, started with `pg_ctl`
+(listening only on a Unix socket in that directory), and removed afterwards.
+`nfldbproj.connect` installs the nfldb and nfldbproj schemas.
+Synthetic players and schedules are generated for several seasons,
+and the projections of a few sources are loaded for every season but the last.
+Each import stage is then run on a source export of the last season
+(and season totals are imported from a full-league file of the same season), and the report gives
+its rows per second, its round trips to the server (statements and `COPY`s executed)
+and the peak memory allocated by Python while it ran.
+Beforehand, stat projections with fractional values in integer columns are written with every insert method,
+and the script fails unless all store the same rounded values.
+Tracing allocations slows Python-heavy stages; pass --no-memory for timings alone.
+Pass --prometheus to also print the totals of the stages recorded by `nfldbproj.instrument`.
+
+`initdb` refuses to run as root. The `player_search` comparison needs the fuzzystrmatch extension,
+and is skipped if it is not installed.
+
+Usage: python benchmarks/import_hot_paths.py [--seasons 3] [--depth 1] [--sources 2] [--lookups 200]
+                                             [--seed 0] [--pg-bin DIR] [--no-memory] [--prometheus] [--keep]
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import datetime
+import gc
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+import nfldb
+from nfldb.team import teams1
+
+import nfldbproj
+from nfldbproj import import_, instrument, names, trigram, update
+
+USER = 'nfldbproj_bench'
+DATABASE = 'nfldbproj_bench'
+FPSYS = 'bench_fpsys'
+FPSYS_URL = 'http://example.com'
+WEEKS = 17
+
+# Players per team at each position, multiplied by --depth.
+DEPTH_CHART = [
+    ('QB', 3),
+    ('RB', 6),
+    ('WR', 8),
+    ('TE', 4),
+    ('K', 2),
+]
+FIRST_NAMES = ['Aaron', 'Andre', 'Ben', 'Brandon', 'Cam', 'Chris', 'Dak', 'Darius', 'Derek', 'Devin',
+               'Eli', 'Eric', 'Frank', 'Greg', 'Isaiah', 'Jalen', 'Jamal', 'Jordan', 'Josh', 'Julio',
+               'Kenny', 'Kyle', 'Lamar', 'Larry', 'Marcus', 'Matt', 'Mike', 'Nick', 'Odell', 'Phil',
+               'Ray', 'Russell', 'Ryan', 'Sam', 'Stefon', 'Terrell', 'Travis', 'Tyler', 'Victor', 'Will']
+LAST_NAME_SYLLABLES = ['an', 'bar', 'ber', 'cal', 'der', 'dor', 'el', 'fer', 'gan', 'har', 'kin', 'lan',
+                       'ley', 'man', 'mor', 'ner', 'ols', 'per', 'ric', 'ros', 'sen', 'son', 'ter', 'ton',
+                       'van', 'wat', 'wel', 'win', 'yar', 'zel']
+
+# Integer columns of stat_projection written with fractional values by `check_insert_methods`.
+CHECKED_STATS = ['passing_tds', 'passing_yds', 'rushing_yds']
+
+Result = namedtuple('Result', ['stage', 'rows', 'seconds', 'round_trips', 'peak_memory'])
+
+
+class CountingConnection(object):
+    """
+    Wraps a connection, counting the statements and `COPY`s executed by the cursors it creates
+    (including those of `nfldb.Tx`) in `round_trips`.
+    """
+    def __init__(self, conn):
+        self._conn = conn
+        self._factories = {}
+        self.round_trips = 0
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self, name=None, cursor_factory=None, **kwargs):
+        factory = cursor_factory or self._conn.cursor_factory or psycopg2.extensions.cursor
+        if factory not in self._factories:
+            self._factories[factory] = self._counting_factory(factory)
+        return self._conn.cursor(name, cursor_factory=self._factories[factory], **kwargs)
+
+    def _counting_factory(self, factory):
+        counter = self
+
+        def counted(method):
+            def call(cursor, *args, **kwargs):
+                counter.round_trips += 1
+                return method(cursor, *args, **kwargs)
+            return call
+
+        return type('Counting' + factory.__name__, (factory,), {
+            'execute': counted(factory.execute),
+            'copy_expert': counted(factory.copy_expert),
+        })
+
+
+@contextmanager
+def throwaway_server(pg_bin=None, keep=False):
+    """Run a PostgreSQL server with an empty database for the duration, yielding `nfldbproj.connect` arguments."""
+    directory = tempfile.mkdtemp(prefix='nfldbproj-bench-')
+    data = os.path.join(directory, 'data')
+
+    def run(program, *args):
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call([os.path.join(pg_bin, program) if pg_bin else program] + list(args),
+                                  stdout=devnull)
+
+    run('initdb', '-D', data, '-U', USER, '--auth=trust', '--encoding=UTF8')
+    run('pg_ctl', '-D', data, '-l', os.path.join(directory, 'server.log'), '-w',
+        '-o', "-c listen_addresses='' -c unix_socket_directories='{}' -c fsync=off".format(directory), 'start')
+    try:
+        admin = psycopg2.connect(dbname='postgres', user=USER, host=directory)
+        admin.autocommit = True
+        admin.cursor().execute('CREATE DATABASE {}'.format(DATABASE))
+        admin.close()
+        yield {'database': DATABASE, 'user': USER, 'host': directory}
+    finally:
+        run('pg_ctl', '-D', data, '-w', '-m', 'fast', 'stop')
+        if keep:
+            print('Server files kept in {}.'.format(directory))
+        else:
+            shutil.rmtree(directory)
+
+
+def generate(db, seasons, depth, seed=0):
+    """
+    Insert players and a schedule of `seasons` seasons of `WEEKS` weeks into nfldb's tables,
+    and return a source export (with columns `season_year`, `week`, `team`, `opp`,
+    `name`, `fantasy_pos`, `projected_fp` and `fp_variance`) of every player in every game.
+
+    """
+    random = np.random.RandomState(seed)
+    team_ids = [team[0] for team in teams1 if team[0] != 'UNK']
+    last_season = datetime.date.today().year - 1
+    season_years = list(range(last_season - seasons + 1, last_season + 1))
+
+    # A round-robin schedule with every team playing every week.
+    games = []
+    for season_year in season_years:
+        order = list(random.permutation(team_ids))
+        kickoff = datetime.datetime(season_year, 9, 7, 17)
+        for week in range(1, WEEKS + 1):
+            for i in range(len(order) // 2):
+                home, away = order[i], order[-1 - i]
+                games.append((kickoff.strftime('%Y%m%d') + '{:02d}'.format(i), kickoff.isoformat() + '+00:00',
+                              week, season_year, home, away))
+            order = [order[0], order[-1]] + order[1:-1]
+            kickoff += datetime.timedelta(weeks=1)
+
+    positions = [pos for pos, count in DEPTH_CHART for _ in range(count * depth)]
+    n_players = len(team_ids) * len(positions)
+    full_names = set()
+    while len(full_names) < n_players:
+        full_names.add('{} {}'.format(
+            random.choice(FIRST_NAMES),
+            ''.join(random.choice(LAST_NAME_SYLLABLES, random.randint(2, 4))).capitalize(),
+        ))
+    roster = pd.DataFrame({
+        'player_id': ['00-{:07d}'.format(i) for i in range(n_players)],
+        'name': random.permutation(sorted(full_names)),
+        'team': np.repeat(team_ids, len(positions)),
+        'fantasy_pos': positions * len(team_ids),
+    })
+
+    with nfldb.Tx(db) as c:
+        c.execute('''
+            INSERT INTO game (gsis_id, start_time, week, day_of_week, season_year, season_type, finished,
+                              home_team, home_score, home_turnovers, away_team, away_score, away_turnovers,
+                              time_inserted, time_updated)
+              SELECT g.gsis_id, g.start_time::timestamptz, g.week, 'Sunday', g.season_year, 'Regular', true,
+                     g.home_team, 0, 0, g.away_team, 0, 0, now(), now()
+                FROM unnest(%s::text[], %s::text[], %s::integer[], %s::integer[], %s::text[], %s::text[])
+                  AS g (gsis_id, start_time, week, season_year, home_team, away_team)
+        ''', [list(column) for column in zip(*games)])
+        # A trigger adds each player to fantasy_player.
+        c.execute('''
+            INSERT INTO player (player_id, full_name, first_name, last_name, team, position, status)
+              SELECT p.player_id, p.full_name, split_part(p.full_name, ' ', 1),
+                     split_part(p.full_name, ' ', 2), p.team, p.position::player_pos, 'Active'
+                FROM unnest(%s::text[], %s::text[], %s::text[], %s::text[])
+                  AS p (player_id, full_name, team, position)
+        ''', [list(roster[column]) for column in ['player_id', 'name', 'team', 'fantasy_pos']])
+        c.execute('ANALYZE game, player, fantasy_player')
+
+    schedule = pd.DataFrame(
+        [(season_year, week, home, away) for _, _, week, season_year, home, away in games] +
+        [(season_year, week, away, home) for _, _, week, season_year, home, away in games],
+        columns=['season_year', 'week', 'team', 'opp'],
+    )
+    dsts = pd.DataFrame({'name': team_ids, 'team': team_ids, 'fantasy_pos': 'DST'})
+    export = schedule.merge(pd.concat([roster.drop('player_id', axis=1), dsts], ignore_index=True), on='team')
+    export['projected_fp'] = random.gamma(2, 4, len(export)).round(2)
+    export['fp_variance'] = (export['projected_fp'] * random.uniform(0.5, 2, len(export))).round(2)
+    return export.sort_values(['season_year', 'week', 'team']).reset_index(drop=True)
+
+
+def load_history(db, export, sources):
+    """Import the projections of `sources` sources for each season of `export` but the last."""
+    for season_year, season in export.groupby('season_year'):
+        if season_year == export['season_year'].max():
+            continue
+        for i in range(sources):
+            import_.from_dataframe(db, season.drop('season_year', axis=1).copy(),
+                                   _metadata('history_{}'.format(i), season_year), single_transaction=True)
+
+
+def measure(db, stage, rows, function, memory=True):
+    """Run `function` (with no arguments), returning a `Result`."""
+    gc.collect()
+    db.round_trips = 0
+    if memory:
+        tracemalloc.start()
+    start = time.time()
+    function()
+    seconds = time.time() - start
+    peak_memory = tracemalloc.get_traced_memory()[1] if memory else None
+    if memory:
+        tracemalloc.stop()
+    return Result(stage, rows, seconds, db.round_trips, peak_memory)
+
+
+def run_stages(db, export, lookups, memory=True, seed=0):
+    """Run each import stage on the last season of `export`, returning a list of `Result`s."""
+    season_year = int(export['season_year'].max())
+    season = export[export['season_year'] == season_year].drop('season_year', axis=1)
+    metadata = _metadata('bench', season_year)
+    unique_names = list(season.loc[season['fantasy_pos'] != 'DST', 'name'].unique()) + \
+        list(season.loc[season['fantasy_pos'] == 'DST', 'team'].unique())
+    sample = unique_names[:lookups]
+    random = np.random.RandomState(seed)
+    misspelled = [_misspell(name, random) for name in sample]
+    results = []
+
+    def forget_names():
+        names.set_name_cache()
+        trigram._indexes.pop(db.dsn, None)
+
+    forget_names()
+    results.append(measure(db, 'names_to_ids (empty cache)', len(unique_names),
+                           lambda: names.names_to_ids(db, unique_names), memory))
+    results.append(measure(db, 'names_to_ids (cached)', len(unique_names),
+                           lambda: names.names_to_ids(db, unique_names), memory))
+    forget_names()
+    results.append(measure(db, 'name_to_id (empty cache)', len(sample),
+                           lambda: [names.name_to_id(db, name) for name in sample], memory))
+
+    matches = {}
+    index = trigram.player_index(db)
+    results.append(measure(db, 'trigram search (misspelled)', len(sample), lambda: matches.update(
+        trigram=[index.search(name, limit=1) for name in misspelled]
+    ), memory))
+    if _has_fuzzystrmatch(db):
+        results.append(measure(db, 'nfldb.player_search (misspelled)', len(sample), lambda: matches.update(
+            player_search=[nfldb.player_search(db, name, limit=1) for name in misspelled]
+        ), memory))
+
+    df = season.copy()
+    import_._schedules.clear()
+    results.append(measure(db, 'assign_gsis_ids (empty cache)', len(df),
+                           lambda: import_.assign_gsis_ids(db, df, metadata), memory))
+    results.append(measure(db, 'assign_gsis_ids (cached)', len(df),
+                           lambda: import_.assign_gsis_ids(db, df, metadata), memory))
+    import_.fix_dst_names(df)
+    names.set_name_cache()
+    results.append(measure(db, 'assign_player_ids (empty cache)', len(df),
+                           lambda: import_.assign_player_ids(db, df), memory))
+    results.append(measure(db, 'assign_player_ids (cached)', len(df),
+                           lambda: import_.assign_player_ids(db, df), memory))
+
+    check_insert_methods(db, df, season_year, seed)
+
+    weeks = [(int(week), week_df.to_dict('records')) for week, week_df in df.groupby('week')]
+    for method in update.INSERT_METHODS:
+        def insert_weeks():
+            for week, rows in weeks:
+                update.insert_data(db, dict(_metadata('bench_' + method, season_year), week=week), rows,
+                                   method=method)
+        results.append(measure(db, 'insert_data ({}, per week)'.format(method), len(df), insert_weeks, memory))
+
+    for single_transaction in [False, True]:
+        source = 'bench_import_{}'.format('single' if single_transaction else 'weekly')
+        results.append(measure(db, 'from_dataframe ({})'.format(
+            'single transaction' if single_transaction else 'per week'
+        ), len(season), lambda: import_.from_dataframe(
+            db, season.copy(), _metadata(source, season_year), single_transaction=single_transaction
+        ), memory))
+
+    # A full-league file of season totals, against a single week with about as many rows.
+    totals = season.groupby(['name', 'team', 'fantasy_pos'], as_index=False)[['projected_fp', 'fp_variance']].sum()
+    results.append(measure(db, 'from_dataframe (season totals)', len(totals), lambda: import_.from_dataframe(
+        db, totals.copy(), dict(_metadata('bench_season', season_year), projection_scope='season'), season_totals=True
+    ), memory))
+    first_week = season[season['week'] == season['week'].min()]
+    results.append(measure(db, 'from_dataframe (single week)', len(first_week), lambda: import_.from_dataframe(
+        db, first_week.copy(), _metadata('bench_week', season_year), single_week_only=True
+    ), memory))
+
+    for search in sorted(matches):
+        correct = sum(bool(match) and _matched_name(match) == name for match, name in zip(matches[search], sample))
+        print('{}: top match correct for {} of {} misspelled names.'.format(search, correct, len(sample)))
+    return results
+
+
+def check_insert_methods(db, df, season_year, seed=0):
+    """
+    Write stat projections with fractional values in integer columns for one week of `df`
+    (which has game and player ids assigned) with every insert method, through both `insert_data` and
+    `insert_dataframe`, and raise an `AssertionError` unless each stores the values rounded as the server rounds.
+
+    """
+    random = np.random.RandomState(seed)
+    week = int(df['week'].min())
+    rows = df.loc[df['week'] == week, ['team', 'fantasy_pos', 'gsis_id', 'fantasy_player_id']].reset_index(drop=True)
+    values = random.uniform(-3, 300, (len(rows), len(CHECKED_STATS))).round(1)
+    values[random.uniform(size=values.shape) < 0.1] = np.nan
+    values[:4, 0] = [1.5, -2.5, -0.4, 1.7]
+    rows = pd.concat([rows, pd.DataFrame(values, columns=CHECKED_STATS)], axis=1)
+    expected = update._rounded(values)
+
+    sources = []
+    for method in update.INSERT_METHODS:
+        sources.append('check_rows_' + method)
+        update.insert_data(db, _stat_metadata(sources[-1], season_year, week),
+                           rows.astype(object).where(rows.notnull(), None).to_dict('records'), method=method)
+        sources.append('check_frame_' + method)
+        update.insert_dataframe(db, _stat_metadata(sources[-1], season_year, week), rows, method=method)
+
+    with nfldb.Tx(db) as c:
+        c.execute('SELECT source_name, fantasy_player_id, {} FROM stat_projection WHERE source_name = ANY(%s)'.format(
+            ', '.join(CHECKED_STATS)
+        ), (sources,))
+        stored = pd.DataFrame(c.fetchall(), columns=['source_name', 'fantasy_player_id'] + CHECKED_STATS)
+    for source in sources:
+        source_values = stored[stored['source_name'] == source].set_index('fantasy_player_id')[CHECKED_STATS]
+        source_values = source_values.reindex(rows['fantasy_player_id']).astype(float).values
+        differing = (source_values != expected) & ~(np.isnan(source_values) & np.isnan(expected))
+        if differing.any():
+            raise AssertionError('{} stored {} values differing from the rounded input'.format(
+                source, int(differing.sum())
+            ))
+    print('insert methods: {} ways of writing {} rows stored identical values.'.format(len(sources), len(rows)))
+
+
+def report(results):
+    print('\n{:40} {:>8} {:>9} {:>10} {:>12} {:>10}'.format(
+        'stage', 'rows', 'seconds', 'rows/s', 'round trips', 'peak MiB'
+    ))
+    for result in results:
+        print('{:40} {:8d} {:9.3f} {:10.0f} {:12d} {:>10}'.format(
+            result.stage, result.rows, result.seconds, result.rows / max(result.seconds, 1e-9), result.round_trips,
+            '-' if result.peak_memory is None else '{:.1f}'.format(result.peak_memory / 2 ** 20),
+        ))
+
+
+def _metadata(source_name, season_year):
+    return {
+        'source_name': source_name,
+        'fpsys_name': FPSYS,
+        'fpsys_url': FPSYS_URL,
+        'projection_scope': 'week',
+        'season_year': season_year,
+        'season_type': 'Regular',
+    }
+
+
+def _stat_metadata(source_name, season_year, week):
+    metadata = dict(_metadata(source_name, season_year), fpsys_name='None', week=week)
+    del metadata['fpsys_url']
+    return metadata
+
+
+def _misspell(name, random):
+    """Drop one letter from the middle of `name`."""
+    i = random.randint(1, len(name) - 1)
+    return name[:i] + name[i + 1:]
+
+
+def _matched_name(match):
+    """Return the full name of the best match returned by `PlayerIndex.search` or `nfldb.player_search`."""
+    if isinstance(match, list):
+        match = match[0]
+    player = match[0]
+    return player.full_name if player is not None else None
+
+
+def _has_fuzzystrmatch(db):
+    try:
+        with nfldb.Tx(db) as c:
+            c.execute('CREATE EXTENSION IF NOT EXISTS fuzzystrmatch')
+        return True
+    except psycopg2.Error as e:
+        print('Skipping nfldb.player_search: {}'.format(str(e).strip()))
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seasons', type=int, default=3, help='seasons of players and games')
+    parser.add_argument('--depth', type=int, default=1, help='multiplier of the players per team')
+    parser.add_argument('--sources', type=int, default=2, help='projection sources loaded for earlier seasons')
+    parser.add_argument('--lookups', type=int, default=200, help='names looked up one at a time')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pg-bin', help='directory containing initdb and pg_ctl')
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help="don't trace memory allocation")
+    parser.add_argument('--prometheus', action='store_true', help='print the instrumented stage totals')
+    parser.add_argument('--keep', action='store_true', help="don't delete the server's files")
+    args = parser.parse_args()
+
+    with throwaway_server(args.pg_bin, args.keep) as connect_args:
+        conn = nfldbproj.connect(**connect_args)
+        try:
+            db = CountingConnection(conn)
+            export = generate(db, args.seasons, args.depth, args.seed)
+            start = time.time()
+            load_history(db, export, args.sources)
+            print('Generated {} export rows; loaded earlier seasons in {:.1f} s.'.format(
+                len(export), time.time() - start
+            ))
+            with instrument.recording() as recorder:
+                results = run_stages(db, export, args.lookups, args.memory, args.seed)
+        finally:
+            conn.close()
+    report(results)
+    if args.prometheus:
+        print('\n' + recorder.prometheus(), end='')
+
+
+if __name__ == '__main__':
+    main()
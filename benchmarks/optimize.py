@@ -0,0 +1,69 @@
+"""
+Time `nfldbproj.optimize.optimize` on a synthetic main slate.
+
+Each game contributes two teams of players with salaries in DraftKings' ranges
+and projections that rise with salary, plus noise.
+No database is needed.
+
+Usage: python benchmarks/optimize.py [--games 12] [--lineups 1 20 150] [--seed 0]
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from nfldbproj.optimize import optimize
+
+# Players per team, and salary range, at each position.
+TEAM_PLAYERS = [
+    ('QB', 2, 4500, 8500),
+    ('RB', 4, 3000, 9500),
+    ('WR', 6, 3000, 9500),
+    ('TE', 3, 2500, 7500),
+    ('DST', 1, 2000, 4000),
+]
+
+
+def synthetic_slate(games, seed=0):
+    """Return a DataFrame of players as returned by `nfldbproj.optimize.load_slate`, for `games` games."""
+    random = np.random.RandomState(seed)
+    frames = []
+    for team in range(2 * games):
+        for pos, n, low, high in TEAM_PLAYERS:
+            salary = random.randint(low // 100, high // 100 + 1, n) * 100
+            projected_fp = np.maximum(salary / 400 + random.normal(0, 3, n), 0)
+            frames.append(pd.DataFrame({
+                'fantasy_player_id': ['{}{}_{}'.format(pos, team, i) for i in range(n)],
+                'team': 'T{}'.format(team),
+                'fantasy_pos': pos,
+                'salary': salary,
+                'projected_fp': projected_fp.round(2),
+            }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--games', type=int, default=12)
+    parser.add_argument('--lineups', type=int, nargs='+', default=[1, 20, 150])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    players = synthetic_slate(args.games, args.seed)
+    print('{} players in {} games.'.format(len(players), args.games))
+    for n_lineups in args.lineups:
+        start = time.time()
+        lineups = optimize(players, n_lineups=n_lineups)
+        elapsed = time.time() - start
+        totals = lineups.groupby('lineup')['projected_fp'].sum()
+        print('{:>5} lineups: {:7.2f} s, projected points {:.2f} to {:.2f}'.format(
+            n_lineups, elapsed, totals.max(), totals.min()
+        ))
+
+
+if __name__ == '__main__':
+    main()
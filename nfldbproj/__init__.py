@@ -3,4 +3,4 @@ from __future__ import absolute_import, division, print_function
 from nfldbproj.types import ProjEnums
 from nfldbproj.db import __pdoc__ as __nfldbproj_db_pdoc__
 from nfldbproj.db import nfldbproj_api_version, nfldb_api_version, nfldbproj_schema_version, connect
-from nfldbproj.names import add_name_disambiguations, name_to_id
+from nfldbproj.names import add_name_disambiguations, name_to_id, names_to_ids, set_name_cache
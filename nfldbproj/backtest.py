@@ -0,0 +1,184 @@
+"""
+Functions for evaluating fantasy-point projections against actual scores.
+
+Projections are joined to scores in the database, so only the matched pairs are transferred,
+and error metrics are computed with NumPy over whole columns,
+one group per fantasy-point system, week, source and position.
+Each source is represented by its most recent weekly projection set for the week.
+Players without a score (e.g. inactive players) are not evaluated.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+import numpy as np
+import pandas as pd
+from psycopg2.extensions import cursor as tuple_cursor
+
+from nfldb import Tx
+
+from nfldbproj.query import _where, _frame
+
+WEEK_COLUMNS = ['fpsys_name', 'season_year', 'season_type', 'week']
+GROUP_COLUMNS = WEEK_COLUMNS + ['source_name', 'fantasy_pos']
+METRICS = ['n', 'mae', 'rmse', 'bias', 'spearman']
+
+# Metrics of finished weeks by (connection DSN, fpsys_name, season_year, season_type, week). See `evaluate`.
+_evaluations = {}
+
+
+def evaluate(db, fpsys=None, season_year=None, season_type='Regular', week=None,
+             source=None, position=None, refresh=False):
+    """
+    Return a DataFrame of projection accuracy with a row per fantasy-point system, week, source and position,
+    with the columns of `GROUP_COLUMNS` and `METRICS`:
+    the number of players scored `n`, the mean absolute error `mae`, the root-mean-square error `rmse`,
+    the mean error `bias` (positive when projections are too high),
+    and the Spearman rank correlation `spearman` between projected and actual points.
+
+    Filter arguments are as for `nfldbproj.query.fp_projections`.
+    Metrics of weeks whose games have all finished are cached for the life of the process,
+    so evaluating a longer range of seasons later only computes the new weeks.
+    Pass `refresh=True` to recompute them, e.g. after importing more projections or scores for past weeks.
+
+    """
+    where, params = _where(OrderedDict([
+        ('fpsys_name', fpsys),
+        ('projection_scope', 'week'),
+        ('season_year', season_year),
+        ('season_type', season_type),
+        ('week', week),
+    ]), 's')
+
+    with Tx(db, factory=tuple_cursor) as c:
+        c.execute('''
+            SELECT s.fpsys_name, s.season_year, s.season_type::text, s.week, bool_and(g.finished)
+              FROM (
+                  SELECT DISTINCT s.fpsys_name, s.season_year, s.season_type, s.week FROM projection_set AS s
+                    {} AND s.fpsys_name != 'None'
+              ) AS s
+              JOIN game AS g ON (g.season_year, g.season_type, g.week) = (s.season_year, s.season_type, s.week)
+              GROUP BY s.fpsys_name, s.season_year, s.season_type, s.week
+        '''.format(where), params)
+        weeks = OrderedDict(((db.dsn,) + tuple(row[:4]), row[4]) for row in c.fetchall())
+
+        pending = [key for key in weeks if refresh or key not in _evaluations]
+        computed = _metrics(_scored_projections(c, [key[1:] for key in pending])) if pending else None
+
+    results = {key: _evaluations[key] for key in weeks if key not in pending}
+    if computed is not None:
+        for week_key, week_metrics in computed.groupby(WEEK_COLUMNS, sort=False):
+            key = (db.dsn,) + tuple(week_key)
+            results[key] = week_metrics
+            if weeks.get(key):
+                _evaluations[key] = week_metrics
+
+    frames = [results[key] for key in sorted(results)]
+    metrics = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=GROUP_COLUMNS + METRICS)
+    for column, values in [('source_name', source), ('fantasy_pos', position)]:
+        if values is not None:
+            if not isinstance(values, (list, tuple, set, frozenset)):
+                values = [values]
+            metrics = metrics[metrics[column].isin([getattr(value, 'name', value) for value in values])]
+    return metrics.reset_index(drop=True)
+
+
+def summarize(metrics, by=('source_name', 'fantasy_pos')):
+    """
+    Combine the weekly metrics returned by `evaluate` over all weeks, grouping by the columns `by`.
+    Errors are pooled over all players (weighting each week by `n`),
+    and `spearman` is the mean of the weekly rank correlations.
+
+    """
+    by = list(by)
+    n = metrics['n']
+    totals = pd.DataFrame({
+        'n': n,
+        'abs_error': metrics['mae'] * n,
+        'squared_error': metrics['rmse'] ** 2 * n,
+        'error': metrics['bias'] * n,
+    })
+    totals[by] = metrics[by]
+    grouped = totals.groupby(by)
+    sums = grouped[['n', 'abs_error', 'squared_error', 'error']].sum()
+    return pd.DataFrame(OrderedDict([
+        ('n', sums['n']),
+        ('mae', sums['abs_error'] / sums['n']),
+        ('rmse', np.sqrt(sums['squared_error'] / sums['n'])),
+        ('bias', sums['error'] / sums['n']),
+        ('spearman', metrics.groupby(by)['spearman'].mean()),
+    ])).reset_index()
+
+
+def _scored_projections(cursor, weeks):
+    """
+    Return a DataFrame of projected and actual points for the `(fpsys_name, season_year, season_type, week)`
+    tuples `weeks`, from the latest projection set of each source, sorted by `GROUP_COLUMNS`.
+
+    """
+    fpsys_names, season_years, season_types, week_numbers = (list(column) for column in zip(*weeks))
+    cursor.execute('''
+        SELECT s.fpsys_name, s.season_year, s.season_type::text AS season_type, s.week,
+               s.source_name, p.fantasy_pos::text AS fantasy_pos, p.projected_fp, f.actual_fp
+          FROM (
+              SELECT DISTINCT ON (s.source_name, s.fpsys_name, s.season_year, s.season_type, s.week)
+                     s.source_name, s.fpsys_name, s.set_id, s.season_year, s.season_type, s.week
+                FROM projection_set AS s
+                JOIN unnest(%s::text[], %s::integer[], %s::season_phase[], %s::integer[])
+                  AS w (fpsys_name, season_year, season_type, week)
+                  ON (s.fpsys_name, s.season_year, s.season_type, s.week)
+                   = (w.fpsys_name, w.season_year, w.season_type, w.week)
+                WHERE s.projection_scope = 'week'
+                ORDER BY s.source_name, s.fpsys_name, s.season_year, s.season_type, s.week,
+                         s.date_accessed DESC, s.set_id DESC
+          ) AS s
+          JOIN fp_projection AS p USING (source_name, fpsys_name, set_id, season_year)
+          JOIN fp_score AS f
+            ON (f.fpsys_name, f.gsis_id, f.fantasy_player_id) = (p.fpsys_name, p.gsis_id, p.fantasy_player_id)
+          -- Restricts the partitions of fp_projection scanned, which the join alone does not at plan time.
+          WHERE p.season_year = ANY(%s)
+          ORDER BY s.fpsys_name, s.season_year, s.season_type, s.week, s.source_name, p.fantasy_pos
+    ''', (fpsys_names, season_years, season_types, week_numbers, sorted(set(season_years))))
+    return _frame(cursor)
+
+
+def _metrics(scored):
+    """
+    Compute `METRICS` for each group of consecutive rows of `scored` with equal `GROUP_COLUMNS`,
+    using `np.add.reduceat` over the group boundaries.
+
+    """
+    if not len(scored):
+        return pd.DataFrame(columns=GROUP_COLUMNS + METRICS)
+
+    keys = scored[GROUP_COLUMNS].values
+    starts = np.flatnonzero(np.r_[True, (keys[1:] != keys[:-1]).any(axis=1)])
+    n = np.diff(np.r_[starts, len(scored)])
+
+    projected = scored['projected_fp'].values.astype(float)
+    actual = scored['actual_fp'].values.astype(float)
+    error = projected - actual
+
+    # Spearman's correlation is Pearson's correlation of the ranks (with ties given their average rank).
+    group = np.repeat(np.arange(len(starts)), n)
+    projected_rank = pd.Series(projected).groupby(group).rank().values
+    actual_rank = pd.Series(actual).groupby(group).rank().values
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_projected_rank = np.add.reduceat(projected_rank, starts) / n
+        mean_actual_rank = np.add.reduceat(actual_rank, starts) / n
+        covariance = np.add.reduceat(projected_rank * actual_rank, starts) / n - mean_projected_rank * mean_actual_rank
+        projected_variance = np.add.reduceat(projected_rank ** 2, starts) / n - mean_projected_rank ** 2
+        actual_variance = np.add.reduceat(actual_rank ** 2, starts) / n - mean_actual_rank ** 2
+        spearman = covariance / np.sqrt(projected_variance * actual_variance)
+
+    metrics = scored[GROUP_COLUMNS].iloc[starts].reset_index(drop=True)
+    metrics['n'] = n
+    metrics['mae'] = np.add.reduceat(np.abs(error), starts) / n
+    metrics['rmse'] = np.sqrt(np.add.reduceat(error ** 2, starts) / n)
+    metrics['bias'] = np.add.reduceat(error, starts) / n
+    metrics['spearman'] = np.where(n > 1, spearman, np.nan)
+    return metrics
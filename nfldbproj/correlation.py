@@ -0,0 +1,236 @@
+"""
+Functions for estimating the correlations between the fantasy points of teammates and opponents.
+
+Players are compared by roster slot rather than by name:
+in each game, a team's players at each fantasy position are ranked by their average score in earlier games,
+giving slots such as `QB1`, `RB1`, `RB2` and `WR1`, and the slots of the opposing team (e.g. `opp_QB1`).
+The ranking is done in the database, so only the scores of the players filling a slot are transferred.
+
+Correlations are pairwise-complete (each pair of slots uses the games in which both were filled)
+and are computed with NumPy from sums that are accumulated week by week,
+so the correlations of a season are updated incrementally as new weeks are scored.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+import numpy as np
+import pandas as pd
+from psycopg2.extensions import cursor as tuple_cursor
+
+from nfldb import Tx
+
+from nfldbproj.query import _frame
+
+DEFAULT_SLOTS = OrderedDict([
+    ('QB', 1),
+    ('RB', 2),
+    ('WR', 3),
+    ('TE', 1),
+    ('K', 1),
+    ('DST', 1),
+])
+"""The number of slots of each fantasy position on a team."""
+
+# Sums of slot scores by (connection DSN, fpsys_name, season_year, season_type, slots),
+# as a tuple of the weeks included and their `_Moments`. See `correlations`.
+_statistics = {}
+
+
+def correlations(db, fpsys, season_year, season_type='Regular', slots=DEFAULT_SLOTS, min_periods=10, refresh=False):
+    """
+    Return a DataFrame of the correlations between the fantasy points (under `fpsys`) of the slots
+    of a team and its opponent, indexed by slot in both directions,
+    from the games of `season_year` (a season or list of seasons).
+    Slots are numbered from 1 for each position, up to the number given in `slots`.
+    Correlations based on fewer than `min_periods` games are `NaN`.
+
+    Only weeks whose games have all finished and been scored (see `nfldbproj.scoring.score`) are used.
+    Their sums are cached for the life of the process, so later calls only read the weeks scored since.
+    Pass `refresh=True` to read every week again, e.g. after rescoring.
+
+    """
+    seasons = season_year if isinstance(season_year, (list, tuple, set, frozenset)) else [season_year]
+    slots = OrderedDict((getattr(pos, 'name', pos), count) for pos, count in slots.items())
+    labels = _slot_labels(slots)
+
+    with Tx(db, factory=tuple_cursor) as c:
+        c.execute('''
+            SELECT g.season_year, g.week FROM game AS g
+              LEFT JOIN (SELECT DISTINCT gsis_id FROM fp_score WHERE fpsys_name = %s) AS f ON f.gsis_id = g.gsis_id
+              WHERE g.season_year = ANY(%s) AND g.season_type = %s
+              GROUP BY g.season_year, g.week
+              HAVING bool_and(g.finished AND f.gsis_id IS NOT NULL)
+        ''', (fpsys, list(seasons), season_type))
+        scored_weeks = {}
+        for year, week in c.fetchall():
+            scored_weeks.setdefault(year, set()).add(week)
+
+        keys = OrderedDict((year, (db.dsn, fpsys, year, season_type, tuple(slots.items()))) for year in seasons)
+        cached = {year: ((frozenset(), _Moments(len(labels))) if refresh else
+                         _statistics.get(key, (frozenset(), _Moments(len(labels)))))
+                  for year, key in keys.items()}
+        pending = [(year, week) for year in seasons
+                   for week in sorted(scored_weeks.get(year, set()) - cached[year][0])]
+        scores = _slot_scores(c, fpsys, season_type, slots, pending) if pending else None
+
+    total = _Moments(len(labels))
+    for year, key in keys.items():
+        weeks, moments = cached[year]
+        new_weeks = scored_weeks.get(year, set()) - weeks
+        if new_weeks:
+            moments = _Moments(len(labels)).merge(moments)
+            moments.add(_observations(scores[scores['season_year'] == year], labels))
+            _statistics[key] = (weeks | new_weeks, moments)
+        total.merge(moments)
+    return pd.DataFrame(total.correlation(min_periods), index=labels, columns=labels)
+
+
+def opponents(db, season_year, week, season_type='Regular'):
+    """Return a dictionary mapping each team playing in a week to its opponent."""
+    with Tx(db, factory=tuple_cursor) as c:
+        c.execute('''
+            SELECT home_team, away_team FROM game
+              WHERE season_year = %s AND season_type = %s AND week = %s
+        ''', (season_year, season_type, week))
+        games = c.fetchall()
+    return dict([(home, away) for home, away in games] + [(away, home) for home, away in games])
+
+
+def player_correlations(players, correlation, opponents=None, slots=DEFAULT_SLOTS):
+    """
+    Return the matrix of correlations between the players in the DataFrame `players`
+    (with columns `team`, `fantasy_pos` and `projected_fp`, such as that returned by
+    `nfldbproj.optimize.load_slate`), from the slot correlations `correlation` returned by `correlations`.
+    The result can be passed to `nfldbproj.simulate.simulate`.
+
+    Players are assigned to slots in order of `projected_fp` within their team and position.
+    Players of different teams are uncorrelated unless `opponents` (as returned by `opponents`)
+    says they are playing each other.
+    Players beyond the number of `slots` and unknown correlations are taken to be uncorrelated.
+
+    """
+    slots = OrderedDict((getattr(pos, 'name', pos), count) for pos, count in slots.items())
+    labels = _slot_labels(slots)
+    n_slots = len(labels) // 2
+
+    rank = players.groupby(['team', 'fantasy_pos'])['projected_fp'].rank(method='first', ascending=False)
+    slot_labels = players['fantasy_pos'].astype(str) + rank.astype(int).astype(str)
+    slot = pd.Index(labels[:n_slots]).get_indexer(slot_labels)
+    team = np.asarray(players['team'], dtype=object)
+    opponent = np.asarray(players['team'].map(opponents or {}), dtype=object)
+
+    matrix = np.nan_to_num(np.asarray(correlation, dtype=float))
+    teammate = matrix[slot[:, None], slot[None, :]]
+    opposing = matrix[slot[:, None], slot[None, :] + n_slots]
+    result = np.where(team[:, None] == team[None, :], teammate,
+                      np.where(opponent[:, None] == team[None, :], opposing, 0))
+    result[(slot < 0)[:, None] | (slot < 0)[None, :]] = 0
+    np.fill_diagonal(result, 1)
+    return result
+
+
+def _slot_labels(slots):
+    own = ['{}{}'.format(pos, i) for pos, count in slots.items() for i in range(1, count + 1)]
+    return own + ['opp_' + label for label in own]
+
+
+def _slot_scores(cursor, fpsys, season_type, slots, weeks):
+    """
+    Return a DataFrame of the scores of the players filling `slots` in the games of `weeks`,
+    a list of `(season_year, week)` tuples, with columns `season_year`, `gsis_id`, `team`, `opponent`,
+    `slot` and `actual_fp`.
+    Players are ranked within their team and position by their average score in earlier games.
+
+    """
+    season_years, week_numbers = (list(column) for column in zip(*weeks))
+    cursor.execute('''
+        WITH scores AS (
+            SELECT f.gsis_id, g.season_year, g.season_type, g.week,
+                   f.team, f.fantasy_pos, f.fantasy_player_id, f.actual_fp,
+                   CASE WHEN f.team = g.home_team THEN g.away_team ELSE g.home_team END AS opponent,
+                   avg(f.actual_fp) OVER (
+                       PARTITION BY f.fantasy_player_id ORDER BY g.start_time
+                       ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                   ) AS prior_fp
+              FROM fp_score AS f
+              JOIN game AS g ON g.gsis_id = f.gsis_id
+              WHERE f.fpsys_name = %s AND g.season_year <= %s
+        ), ranked AS (
+            SELECT s.*, row_number() OVER (
+                       PARTITION BY s.gsis_id, s.team, s.fantasy_pos
+                       ORDER BY s.prior_fp DESC NULLS LAST, s.fantasy_player_id
+                   ) AS rank
+              FROM scores AS s
+              JOIN unnest(%s::integer[], %s::integer[]) AS w (season_year, week)
+                ON (w.season_year, w.week) = (s.season_year, s.week)
+              WHERE s.season_type = %s
+        )
+        SELECT r.season_year, r.gsis_id, r.team, r.opponent, r.fantasy_pos::text || r.rank AS slot, r.actual_fp
+          FROM ranked AS r
+          JOIN unnest(%s::fantasy_position[], %s::integer[]) AS n (fantasy_pos, slots)
+            ON n.fantasy_pos = r.fantasy_pos
+          WHERE r.rank <= n.slots
+    ''', (fpsys, max(season_years), season_years, week_numbers, season_type, list(slots), list(slots.values())))
+    return _frame(cursor)
+
+
+def _observations(scores, labels):
+    """
+    Arrange the slot scores returned by `_slot_scores` as an array with a row per team per game
+    and a column per label in `labels` (the team's slots followed by its opponent's), with `NaN` for empty slots.
+
+    """
+    n_slots = len(labels) // 2
+    gsis_id = scores['gsis_id'].astype(str)
+    rows, team_games = pd.factorize(gsis_id + ' ' + scores['team'])
+    observations = np.full((len(team_games), len(labels)), np.nan)
+    observations[rows, pd.Index(labels[:n_slots]).get_indexer(scores['slot'])] = scores['actual_fp'].values
+
+    opponent_row = np.full(len(team_games), -1)
+    opponent_row[rows] = pd.Index(team_games).get_indexer(gsis_id + ' ' + scores['opponent'])
+    has_opponent = opponent_row >= 0
+    observations[has_opponent, n_slots:] = observations[opponent_row[has_opponent], :n_slots]
+    return observations
+
+
+class _Moments(object):
+    """
+    Pairwise-complete sums of a set of variables, from which their correlations are computed.
+    Element `[i, j]` of each array sums over the observations in which both `i` and `j` are present.
+    """
+    def __init__(self, k):
+        self.count = np.zeros((k, k))
+        self.total = np.zeros((k, k))
+        self.total_squares = np.zeros((k, k))
+        self.total_products = np.zeros((k, k))
+
+    def add(self, observations):
+        """Add the rows of `observations`, an array with a column per variable and `NaN` where missing."""
+        present = (~np.isnan(observations)).astype(float)
+        values = np.nan_to_num(observations)
+        self.count += present.T.dot(present)
+        self.total += values.T.dot(present)
+        self.total_squares += (values ** 2).T.dot(present)
+        self.total_products += values.T.dot(values)
+
+    def merge(self, other):
+        """Add the sums of `other` and return self."""
+        self.count += other.count
+        self.total += other.total
+        self.total_squares += other.total_squares
+        self.total_products += other.total_products
+        return self
+
+    def correlation(self, min_periods):
+        n = self.count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            covariance = n * self.total_products - self.total * self.total.T
+            variance = n * self.total_squares - self.total ** 2
+            correlation = covariance / np.sqrt(variance * variance.T)
+        correlation[n < max(min_periods, 2)] = np.nan
+        return np.clip(correlation, -1, 1)
@@ -13,7 +13,7 @@ from nfldbproj.types import ProjEnums
 
 __pdoc__ = {}
 
-nfldbproj_api_version = 1
+nfldbproj_api_version = 5
 __pdoc__['nfldbproj_api_version'] = \
     """
     The nfldbproj schema version that this library corresponds to. When the schema
@@ -41,13 +41,29 @@ nfldbproj_tables = {
     'name_disambiguation',
     'fp_score',
     'fantasy_player',
+    'fp_consensus',
+    'fp_scoring_rule',
 }
+nfldbproj_partitioned_tables = {
+    'stat_projection',
+    'fp_projection',
+}
+__pdoc__['nfldbproj_partitioned_tables'] = \
+    """
+    The nfldbproj tables that are partitioned by `season_year`.
+    The partition for each season is named `{table}_{season_year}`
+    and is created when rows of that season are first inserted.
+    """
+
 nfldbproj_types = {
     'fantasy_position',
     'proj_scope',
     'uinteger',
 }
 
+# Schema catalogs by connection DSN. See `_catalog`.
+_catalogs = {}
+
 
 def uninstall(db, really_uninstall=False):
     """Remove all traces of nfldb-projections."""
@@ -57,6 +73,7 @@ def uninstall(db, really_uninstall=False):
             c.execute('DROP TABLE {}'.format(', '.join(nfldbproj_tables)))
             c.execute('DROP TYPE {}'.format(', '.join(nfldbproj_types)))
             c.execute('DROP FUNCTION add_fantasy_player() CASCADE')
+        _invalidate_catalog(db)
         print('done.')
 
     else:
@@ -149,6 +166,87 @@ def _nfldbproj_is_empty(conn):
     return bool(nfldbproj_tables - table_names)
 
 
+def _catalog(cursor, check_version=False):
+    """
+    Returns the cached schema catalog of the database that `cursor` is connected to,
+    loading it on first use. The catalog is a dictionary with keys
+    `version` (the nfldbproj schema version),
+    `columns` (a dictionary mapping each nfldbproj table to a list of its columns, in table order),
+    `types` (a dictionary mapping each nfldbproj table to a dictionary of column data types),
+    `statements` (a dictionary of compiled SQL statements, see `nfldbproj.update._compiled`),
+    `partitions` (a set of `(table, season_year)` pairs of existing partitions, see `_create_partition`),
+    and `known` (a set of `(table, primary key)` pairs of metadata rows known to exist,
+    see `nfldbproj.update._insert_if_new`).
+
+    Catalogs are kept for the life of the process and dropped by `_migrate_nfldbproj`.
+    A migration run by another process is noticed by passing `check_version=True`,
+    which reads the stored schema version (a single-row query) and reloads the catalog if it differs.
+    The first use of the catalog by each public function passes it; later uses issue no queries.
+    """
+    key = cursor.connection.dsn
+    catalog = _catalogs.get(key)
+    version = None
+    if catalog is not None and check_version:
+        version = _stored_version(cursor)
+        if version != catalog['version']:
+            catalog = None
+    if catalog is None:
+        if version is None:
+            version = _stored_version(cursor)
+        cursor.execute('''
+            SELECT table_name, column_name, data_type FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = ANY(%s)
+            ORDER BY table_name, ordinal_position
+        ''', (list(nfldbproj_tables),))
+        columns = {table: [] for table in nfldbproj_tables}
+        types = {table: {} for table in nfldbproj_tables}
+        for row in cursor.fetchall():
+            columns[row['table_name']].append(row['column_name'])
+            types[row['table_name']][row['column_name']] = row['data_type']
+        cursor.execute('''
+            SELECT parent.relname AS table_name, child.relname AS partition_name FROM pg_inherits
+              JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent
+              JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+              WHERE parent.relname = ANY(%s)
+        ''', (list(nfldbproj_partitioned_tables),))
+        partitions = set()
+        for row in cursor.fetchall():
+            season_year = row['partition_name'][len(row['table_name']) + 1:]
+            if season_year.isdigit():
+                partitions.add((row['table_name'], int(season_year)))
+        catalog = _catalogs[key] = {
+            'version': version, 'columns': columns, 'types': types, 'statements': {},
+            'partitions': partitions, 'known': set(),
+        }
+    return catalog
+
+
+def _stored_version(cursor):
+    cursor.execute('SELECT nfldbproj_version FROM nfldbproj_meta LIMIT 1')
+    return cursor.fetchone()['nfldbproj_version']
+
+
+def _invalidate_catalog(conn):
+    """Drop the cached schema catalog for the database of `conn`, if any."""
+    _catalogs.pop(conn.dsn, None)
+
+
+def _create_partition(cursor, table, season_year):
+    """
+    Create the partition of `table` (one of `nfldbproj_partitioned_tables`) for `season_year`, if it doesn't exist.
+    Concurrent creations of the same partition are serialized by an advisory lock.
+
+    Creating a partition locks its parent table exclusively until the transaction ends,
+    so this should be done in a short transaction of its own.
+    """
+    season_year = int(season_year)
+    cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s), hashtext(%s))',
+                   ('partition', '{}/{}'.format(table, season_year)))
+    cursor.execute('CREATE TABLE IF NOT EXISTS {}_{} PARTITION OF {} FOR VALUES IN (%s)'.format(
+        table, season_year, table
+    ), (season_year,))
+
+
 def _category_sql_field(self):
     """
     Get a modified SQL definition of a statistical category column.
@@ -181,6 +279,7 @@ def _migrate_nfldbproj(conn, to):
             assert fname in globs, 'Migration function {} not defined'.format(v)
             globs[fname](c)
             c.execute("UPDATE nfldbproj_meta SET nfldbproj_version = %s", (v,))
+        _invalidate_catalog(conn)
 
 
 def _create_enum(c, enum):
@@ -461,3 +560,207 @@ def _migrate_nfldbproj_1(c):
                 INSERT INTO name_disambiguation (name_as_scraped, fantasy_player_id)
                   VALUES (%s, %s)
             ''', (team_name, team_names[0]))
+
+
+def _migrate_nfldbproj_2(c):
+    print('Adding fp_consensus table to the database...', file=sys.stderr)
+
+    c.execute('''
+        CREATE TABLE fp_consensus (
+            fpsys_name character varying (100) NOT NULL CHECK (fpsys_name != 'None'),
+            season_year usmallint NOT NULL,
+            season_type season_phase NOT NULL,
+            week usmallint NOT NULL,
+            fantasy_player_id character varying (10) NOT NULL,
+            team character varying (3) NOT NULL,
+            fantasy_pos fantasy_position NOT NULL,
+            n_sources usmallint NOT NULL,
+            mean_fp real NOT NULL,
+            median_fp real NOT NULL,
+            stdev_fp real NULL,
+            PRIMARY KEY (fpsys_name, season_year, season_type, week, fantasy_player_id),
+            FOREIGN KEY (fpsys_name)
+                REFERENCES fp_system (fpsys_name)
+                ON DELETE CASCADE,
+            FOREIGN KEY (fantasy_player_id)
+                REFERENCES fantasy_player (fantasy_player_id)
+                ON DELETE RESTRICT,
+            FOREIGN KEY (team)
+                REFERENCES team (team_id)
+                ON DELETE RESTRICT
+                ON UPDATE CASCADE
+        )
+    ''')
+
+    # Consensus of the most recent weekly projection set of each source, for every week already stored.
+    c.execute('''
+        INSERT INTO fp_consensus
+          SELECT p.fpsys_name, s.season_year, s.season_type, s.week, p.fantasy_player_id,
+                 max(p.team), max(p.fantasy_pos), count(*), avg(p.projected_fp),
+                 percentile_cont(0.5) WITHIN GROUP (ORDER BY p.projected_fp), stddev_samp(p.projected_fp)
+          FROM (
+              SELECT DISTINCT ON (source_name, fpsys_name, season_year, season_type, week)
+                     source_name, fpsys_name, set_id, season_year, season_type, week
+                FROM projection_set
+                WHERE projection_scope = 'week' AND fpsys_name != 'None'
+                ORDER BY source_name, fpsys_name, season_year, season_type, week,
+                         date_accessed DESC, set_id DESC
+          ) AS s
+          JOIN fp_projection AS p USING (source_name, fpsys_name, set_id)
+          GROUP BY p.fpsys_name, s.season_year, s.season_type, s.week, p.fantasy_player_id
+    ''')
+
+
+# Secondary indexes added by _migrate_nfldbproj_3, as (name, table, columns).
+_access_path_indexes = [
+    # Player history.
+    ('stat_projection_in_player', 'stat_projection', 'fantasy_player_id'),
+    ('fp_projection_in_player', 'fp_projection', 'fantasy_player_id'),
+    ('fp_score_in_player', 'fp_score', 'fantasy_player_id'),
+    ('dfs_salary_in_player', 'dfs_salary', 'fantasy_player_id, season_year DESC, season_type, week DESC'),
+    # Game slate.
+    ('stat_projection_in_game', 'stat_projection', 'gsis_id'),
+    ('fp_projection_in_game', 'fp_projection', 'gsis_id'),
+    ('fp_score_in_game', 'fp_score', 'gsis_id'),
+    ('dfs_salary_in_week', 'dfs_salary', 'fpsys_name, dfs_name, season_year, season_type, week'),
+    # Latest projection set per source and week.
+    ('projection_set_latest', 'projection_set',
+     'fpsys_name, season_year, season_type, week, source_name, date_accessed DESC, set_id DESC'),
+]
+
+
+def _migrate_nfldbproj_3(c):
+    print('Adding nfldb-projections lookup indexes to the database...', file=sys.stderr)
+
+    for name, table, columns in _access_path_indexes:
+        c.execute('CREATE INDEX {} ON {} ({})'.format(name, table, columns))
+
+
+def _migrate_nfldbproj_4(c):
+    print('Partitioning projection tables by season...', file=sys.stderr)
+
+    # Data rows carry the season of their projection set, which the foreign key keeps consistent.
+    c.execute('''
+        ALTER TABLE projection_set
+          ADD CONSTRAINT projection_set_season_key UNIQUE (source_name, fpsys_name, set_id, season_year)
+    ''')
+
+    for table in sorted(nfldbproj_partitioned_tables):
+        for name, index_table, _ in _access_path_indexes:
+            if index_table == table:
+                c.execute('DROP INDEX {}'.format(name))
+        c.execute('ALTER TABLE {0} RENAME TO {0}_unpartitioned'.format(table))
+        c.execute('ALTER INDEX {0}_pkey RENAME TO {0}_unpartitioned_pkey'.format(table))
+
+    c.execute('''
+        CREATE TABLE stat_projection (
+            source_name character varying (100) NOT NULL,
+            fpsys_name character varying (100) NOT NULL CHECK (fpsys_name = 'None'),
+            set_id integer NOT NULL,
+            season_year usmallint NOT NULL,
+            fantasy_player_id character varying (10) NOT NULL,
+            gsis_id gameid NULL,
+            team character varying (3) NOT NULL,
+            fantasy_pos fantasy_position NOT NULL,
+            {},
+            PRIMARY KEY (source_name, fpsys_name, set_id, fantasy_player_id, season_year),
+            FOREIGN KEY (source_name)
+                REFERENCES projection_source (source_name)
+                ON DELETE CASCADE,
+            FOREIGN KEY (source_name, fpsys_name, set_id, season_year)
+                REFERENCES projection_set (source_name, fpsys_name, set_id, season_year)
+                ON DELETE CASCADE,
+            FOREIGN KEY (fantasy_player_id)
+                REFERENCES fantasy_player (fantasy_player_id)
+                ON DELETE RESTRICT,
+            FOREIGN KEY (gsis_id)
+                REFERENCES game (gsis_id)
+                ON DELETE RESTRICT,
+            FOREIGN KEY (team)
+                REFERENCES team (team_id)
+                ON DELETE RESTRICT
+                ON UPDATE CASCADE
+        ) PARTITION BY LIST (season_year)
+    '''.format(
+        ', '.join(_category_sql_field(cat) for cat in _player_categories.values())
+    ))
+
+    c.execute('''
+        CREATE TABLE fp_projection (
+            source_name character varying (100) NOT NULL,
+            fpsys_name character varying (100) NOT NULL CHECK (fpsys_name != 'None'),
+            set_id usmallint NOT NULL,
+            season_year usmallint NOT NULL,
+            fantasy_player_id character varying (10) NOT NULL,
+            gsis_id gameid NULL,
+            team character varying (3) NOT NULL,
+            fantasy_pos fantasy_position NOT NULL,
+            projected_fp real NOT NULL,
+            fp_variance real NULL CHECK (fp_variance >= 0),
+            PRIMARY KEY (source_name, fpsys_name, set_id, fantasy_player_id, season_year),
+            FOREIGN KEY (source_name)
+                REFERENCES projection_source (source_name)
+                ON DELETE CASCADE,
+            FOREIGN KEY (source_name, fpsys_name, set_id, season_year)
+                REFERENCES projection_set (source_name, fpsys_name, set_id, season_year)
+                ON DELETE CASCADE,
+            FOREIGN KEY (fpsys_name)
+                REFERENCES fp_system (fpsys_name)
+                ON DELETE CASCADE,
+            FOREIGN KEY (fantasy_player_id)
+                REFERENCES fantasy_player (fantasy_player_id)
+                ON DELETE RESTRICT,
+            FOREIGN KEY (gsis_id)
+                REFERENCES game (gsis_id)
+                ON DELETE RESTRICT,
+            FOREIGN KEY (team)
+                REFERENCES team (team_id)
+                ON DELETE RESTRICT
+                ON UPDATE CASCADE
+        ) PARTITION BY LIST (season_year)
+    ''')
+
+    c.execute('SELECT DISTINCT season_year FROM projection_set ORDER BY season_year')
+    season_years = [row['season_year'] for row in c.fetchall()]
+    for table in sorted(nfldbproj_partitioned_tables):
+        for season_year in season_years:
+            _create_partition(c, table, season_year)
+
+        c.execute('''
+            SELECT column_name FROM information_schema.columns
+              WHERE table_schema = 'public' AND table_name = %s
+              ORDER BY ordinal_position
+        ''', ('{}_unpartitioned'.format(table),))
+        columns = [row['column_name'] for row in c.fetchall()]
+        c.execute('''
+            INSERT INTO {table} ({columns}, season_year)
+              SELECT {data_columns}, s.season_year FROM {table}_unpartitioned AS d
+              JOIN projection_set AS s USING (source_name, fpsys_name, set_id)
+        '''.format(
+            table=table,
+            columns=', '.join(columns),
+            data_columns=', '.join('d.{}'.format(column) for column in columns),
+        ))
+        c.execute('DROP TABLE {}_unpartitioned'.format(table))
+
+        # Indexes on the parent table are created on every partition.
+        for name, index_table, index_columns in _access_path_indexes:
+            if index_table == table:
+                c.execute('CREATE INDEX {} ON {} ({})'.format(name, table, index_columns))
+
+
+def _migrate_nfldbproj_5(c):
+    print('Adding fp_scoring_rule table to the database...', file=sys.stderr)
+
+    c.execute('''
+        CREATE TABLE fp_scoring_rule (
+            fpsys_name character varying (100) NOT NULL CHECK (fpsys_name != 'None'),
+            dst boolean NOT NULL,
+            category_id character varying (50) NOT NULL,
+            points real NOT NULL,
+            PRIMARY KEY (fpsys_name, dst, category_id),
+            FOREIGN KEY (fpsys_name)
+                REFERENCES fp_system (fpsys_name)
+                ON DELETE CASCADE
+        )
+    ''')
@@ -1,14 +1,46 @@
 from __future__ import absolute_import, division, print_function
 
+import threading
+import traceback
+from multiprocessing.pool import ThreadPool
+
 import pandas as pd
 import nfldb
+from nfldb import Tx
 from nfldb.update import log
-from nfldbproj.names import name_to_id
-from nfldbproj import update
+from nfldbproj.db import connect as nfldbproj_connect
+from nfldbproj.names import names_to_ids
+from nfldbproj import instrument, update
+
+
+# Season schedules by (connection DSN, season_year, season_type). See `season_schedule`.
+_schedules = {}
+
+DEFAULT_CHUNKSIZE = 50000
 
 
 def from_dataframe(db, df, metadata, single_week_only=False, season_totals=False,
-                   fp_projection=True, stat_projection=True, fp_score=False, dfs_salary=False):
+                   fp_projection=True, stat_projection=True, fp_score=False, dfs_salary=False,
+                   set_ids=None, **kwargs):
+    """
+    Insert the projections, scores and/or salaries in `df` into the database.
+    Each kind of data is written only if its columns are present.
+
+    Each week is imported in one transaction, writing every target table
+    for that week with shared metadata.
+    Pass `single_transaction=True` to import all weeks in one transaction instead,
+    allocating every projection set at once; this suits season backfills.
+    To import weeks concurrently instead,
+    pass `workers` greater than 1 and a function `connect` returning a new database connection
+    (by default `nfldbproj.connect` with no arguments, i.e. using the nfldb configuration file).
+    Each worker opens one connection.
+
+    To add rows to projection sets created by an earlier call, pass the same dictionary as `set_ids`
+    to both calls; it maps `(fpsys_name, week)` to `set_id`.
+
+    Additional keyword arguments (notably `method` and `locking`) are passed to `nfldbproj.update.insert_dataframes`.
+
+    """
     if 'opp' in df:
         df = drop_byes(df)
 
@@ -20,78 +52,189 @@ def from_dataframe(db, df, metadata, single_week_only=False, season_totals=False
     if 'fantasy_player_id' not in df:
         assign_player_ids(db, df)
 
-    if fp_projection:
-        fp_df = pd.DataFrame(index=df.index)
-        for column in ('fantasy_player_id', 'gsis_id', 'team', 'fantasy_pos', 'projected_fp', 'fp_variance', 'week'):
-            if column in df:
-                fp_df[column] = df[column]
-
-        _from_dataframe_filtered(db, drop_null(fp_df, 'projected_fp'), metadata,
-                                 season_totals=season_totals,
-                                 single_week_only=single_week_only)
-
-    if stat_projection:
-        stat_df = df.copy()
+    # The data tables read the columns they need from df, so no per-table copies are made.
+    available = update._tables_from_headers(df.columns)
+    fp_tables = [
+        (table, required_column)
+        for wanted, table, required_column in [
+            (fp_projection, 'fp_projection', 'projected_fp'),
+            (fp_score, 'fp_score', 'actual_fp'),
+            (dfs_salary, 'dfs_salary', 'salary'),
+        ]
+        if wanted and table in available
+    ]
+    targets = [(metadata, fp_tables)] if fp_tables else []
+
+    if stat_projection and 'stat_projection' in available:
         stat_metadata = metadata.copy()
         stat_metadata['fpsys_name'] = 'None'
         if 'fpsys_url' in stat_metadata:
             del stat_metadata['fpsys_url']
-        for column in ('projected_fp', 'fp_variance', 'actual_fp', 'salary'):
-            if column in stat_df:
-                del stat_df[column]
-
-        _from_dataframe_filtered(db, stat_df, stat_metadata,
-                                 season_totals=season_totals,
-                                 single_week_only=single_week_only)
-
-    if fp_score:
-        results_df = pd.DataFrame(index=df.index)
-        for column in ('fantasy_player_id', 'gsis_id', 'team', 'fantasy_pos', 'actual_fp', 'week'):
-            if column in df:
-                results_df[column] = df[column]
-
-        _from_dataframe_filtered(db, results_df, metadata,
-                                 season_totals=season_totals,
-                                 single_week_only=single_week_only)
-
-    if dfs_salary:
-        salary_df = pd.DataFrame(index=df.index)
-        for column in ('fantasy_player_id', 'gsis_id', 'team', 'fantasy_pos', 'salary', 'week'):
-            if column in df:
-                salary_df[column] = df[column]
-
-        _from_dataframe_filtered(db, drop_null(salary_df, 'salary'), metadata,
-                                 season_totals=season_totals,
-                                 single_week_only=single_week_only)
-
-
-def _from_dataframe_filtered(db, df, metadata, season_totals=False, single_week_only=False):
+        targets.append((stat_metadata, [('stat_projection', None)]))
+
+    if targets:
+        _from_dataframe_filtered(db, df, targets,
+                                 season_totals=season_totals, single_week_only=single_week_only,
+                                 set_ids=set_ids, **kwargs)
+
+
+def from_csv(db, filepath_or_buffer, metadata, chunksize=DEFAULT_CHUNKSIZE, read_options=None, **kwargs):
+    """
+    Like `from_dataframe`, but reads a source export with `pandas.read_csv`, `chunksize` rows at a time,
+    so that memory use is bounded by the chunk size rather than the file size.
+    `read_options` are passed to `pandas.read_csv`;
+    for example, tab-separated exports (such as FantasyPros' "xls" downloads) need `{'sep': '\\t'}`.
+
+    Each chunk is written in its own transactions, and rows of the same week in different chunks
+    are added to the same projection set.
+    Other keyword arguments are passed to `from_dataframe`.
+
+    """
+    set_ids = kwargs.pop('set_ids', None)
+    if set_ids is None:
+        set_ids = {}
+    for i, chunk in enumerate(pd.read_csv(filepath_or_buffer, chunksize=chunksize, **(read_options or {}))):
+        log('importing chunk {}...'.format(i))
+        from_dataframe(db, chunk, metadata, set_ids=set_ids, **kwargs)
+
+
+def _from_dataframe_filtered(db, df, targets, season_totals=False, single_week_only=False,
+                             single_transaction=False, workers=1, connect=nfldbproj_connect, **kwargs):
+    """
+    Write `df` into the data tables given by `targets`,
+    a list of `(metadata, [(table, required_column), ...])` pairs
+    (rows missing a table's `required_column` are not written to it),
+    one transaction per week covering every target
+    (or one transaction for all weeks if `single_transaction`).
+
+    """
     if season_totals:
-        return _from_season_dataframe(db, df, metadata)
+        return _from_season_dataframe(db, df, targets, **kwargs)
 
     if single_week_only:
-        return _from_week_dataframe(db, df, metadata)
-
-    for week, week_df in df.groupby('week'):
-        week_metadata = metadata.copy()
-        week_metadata['week'] = week
-        _from_week_dataframe(db, week_df, week_metadata)
-
-
-def _from_week_dataframe(db, df, metadata):
+        return _from_week_dataframe(db, df, targets, **kwargs)
+
+    jobs = list(df.groupby('week'))
+    if single_transaction:
+        set_ids = kwargs.pop('set_ids', None)
+        batches = []
+        for week, week_df in jobs:
+            batches.extend(_batches(week_df, targets, lambda metadata: dict(metadata, week=int(week))))
+        return _insert_batches(db, batches, set_ids, **kwargs)
+
+    if workers > 1 and len(jobs) > 1:
+        return _from_weeks_parallel(jobs, targets, workers, connect, **kwargs)
+
+    for week, week_df in jobs:
+        _from_week_dataframe(db, week_df, targets, **kwargs)
+
+
+def _from_weeks_parallel(jobs, targets, workers, connect, **kwargs):
+    """
+    Import each `(week, df)` in `jobs` on a pool of at most `workers` threads,
+    each using its own connection from `connect`.
+    Once all weeks have been attempted, every failure is reported in week order
+    and the first one is raised.
+
+    """
+    local = threading.local()
+    connections = []
+
+    def import_week(job):
+        week, week_df = job
+        try:
+            if not hasattr(local, 'db'):
+                local.db = connect()
+                connections.append(local.db)
+            _from_week_dataframe(local.db, week_df, targets, **kwargs)
+        except Exception as e:
+            return week, e, traceback.format_exc()
+        return week, None, None
+
+    pool = ThreadPool(min(workers, len(jobs)))
+    try:
+        results = pool.map(import_week, jobs)
+    finally:
+        pool.close()
+        pool.join()
+        for conn in connections:
+            conn.close()
+
+    failures = [(week, e, tb) for week, e, tb in results if e is not None]
+    for week, _, tb in failures:
+        update.error('importing week {} failed:\n{}'.format(week, tb))
+    if failures:
+        raise failures[0][1]
+
+
+def _from_week_dataframe(db, df, targets, set_ids=None, **kwargs):
     if len(df['week'].unique()) > 1:
         raise ValueError('More than one week in data')
-    metadata['week'] = df['week'].iloc[0]
-    update.insert_data(db, metadata, _df_to_dicts(df))
-
-
-def _from_season_dataframe(db, df, metadata):
-    pass
-
-
-def _df_to_dicts(df):
-    for _, row in df.iterrows():
-        yield dict(row[~row.isnull()])
+    week = int(df['week'].iloc[0])
+    _insert_batches(db, _batches(df, targets, lambda metadata: dict(metadata, week=week)), set_ids, **kwargs)
+
+
+def _from_season_dataframe(db, df, targets, set_ids=None, **kwargs):
+    """
+    Insert a season-long (`projection_scope` `'season'`, the default)
+    or rest-of-season (`'rest_of_season'`) projection set in a single transaction.
+    Rest-of-season projections need the week they were made for,
+    either in `metadata` or as the only value of the `week` column.
+
+    """
+    def season_metadata(metadata):
+        metadata = metadata.copy()
+        scope = getattr(metadata.setdefault('projection_scope', 'season'), 'name', metadata['projection_scope'])
+        if scope == 'season':
+            metadata['week'] = None
+        elif scope == 'rest_of_season':
+            if metadata.get('week') is None:
+                if 'week' not in df or len(df['week'].unique()) != 1:
+                    raise ValueError('Rest-of-season projections need a single week, in metadata or data')
+                metadata['week'] = int(df['week'].iloc[0])
+        else:
+            raise ValueError(
+                'season_totals needs a projection_scope of season or rest_of_season, not {}'.format(scope)
+            )
+        return metadata
+
+    _insert_batches(db, _batches(df, targets, season_metadata), set_ids, **kwargs)
+
+
+def _batches(df, targets, prepare_metadata):
+    """
+    Return the batches for `nfldbproj.update.insert_dataframes` that write `df` into `targets`
+    (see `_from_dataframe_filtered`), using `prepare_metadata` to derive the metadata of each target.
+    Tables of the same target share one metadata dictionary, and so one projection set.
+
+    """
+    batches = []
+    for metadata, tables in targets:
+        metadata = prepare_metadata(metadata)
+        for table, required_column in tables:
+            rows = df if required_column is None else drop_null(df, required_column)
+            batches.append((metadata, rows, [table]))
+    return batches
+
+
+def _insert_batches(db, batches, set_ids, **kwargs):
+    """
+    Insert `batches` with `nfldbproj.update.insert_dataframes`,
+    reusing the projection sets recorded in `set_ids` for the same fantasy-point system and week, if any,
+    and recording the projection sets used.
+
+    """
+    def key(metadata):
+        return metadata.get('fpsys_name'), metadata.get('week')
+
+    if set_ids is None:
+        return update.insert_dataframes(db, batches, **kwargs)
+
+    used = update.insert_dataframes(db, batches, set_ids=[set_ids.get(key(metadata)) for metadata, _, _ in batches],
+                                    **kwargs)
+    for (metadata, _, _), set_id in zip(batches, used):
+        if set_id is not None:
+            set_ids[key(metadata)] = set_id
 
 
 def drop_byes(df):
@@ -102,20 +245,50 @@ def drop_null(df, column):
     return df.drop(df.index[df[column].isnull()], axis=0)
 
 
+@instrument.staged('assign_gsis_ids')
 def assign_gsis_ids(db, df, metadata):
     log('finding game ids...', end='')
-    for (week, team, home, opp), sub_df in df.groupby(['week', 'team', 'home', 'opp']):
-        gsis_id = get_gsis_id(
-            db,
-            season_year=metadata['season_year'],
-            season_type=metadata.get('season_type', 'Regular'),
-            week=week,
-            home_team=team if home else opp,
-        )
-        df.loc[(df['week'] == week) & (df['team'] == team), 'gsis_id'] = gsis_id
+    schedule = season_schedule(db, metadata['season_year'], metadata.get('season_type', 'Regular'))
+    keys = pd.MultiIndex.from_arrays([df['week'], df['team']])
+    gsis_ids = schedule.reindex(keys)
+    missing = gsis_ids.isnull().values
+    if missing.any():
+        raise ValueError('Could not find games for (week, team) {}'.format(sorted(set(keys[missing]))))
+    df['gsis_id'] = gsis_ids.values
+    instrument.add_rows(len(df))
     log('done')
 
 
+def season_schedule(db, season_year, season_type='Regular', refresh=False):
+    """
+    Return a Series of `gsis_id`s indexed by `(week, team)`, covering every team's game in every week of a season.
+    The schedule is loaded in a single query and cached for later imports of the same season;
+    pass `refresh=True` to reload it.
+
+    """
+    key = (db.dsn, season_year, season_type)
+    if refresh or key not in _schedules:
+        with Tx(db, factory=instrument.Cursor) as c:
+            c.execute('''
+                SELECT week, home_team AS team, gsis_id FROM game
+                  WHERE season_year = %(season_year)s AND season_type = %(season_type)s
+                UNION ALL
+                SELECT week, away_team AS team, gsis_id FROM game
+                  WHERE season_year = %(season_year)s AND season_type = %(season_type)s
+            ''', {'season_year': season_year, 'season_type': season_type})
+            games = c.fetchall()
+
+        schedule = pd.DataFrame(games, columns=['week', 'team', 'gsis_id']).set_index(['week', 'team'])['gsis_id']
+        duplicated = schedule.index.duplicated()
+        if duplicated.any():
+            raise ValueError('Found more than one game for (week, team) {}'.format(
+                sorted(set(schedule.index[duplicated]))
+            ))
+        _schedules[key] = schedule
+
+    return _schedules[key]
+
+
 def get_gsis_id(db, **data):
     q = nfldb.Query(db)
     games = q.game(**data).as_games()
@@ -126,11 +299,11 @@ def get_gsis_id(db, **data):
     return games[0].gsis_id
 
 
+@instrument.staged('assign_player_ids')
 def assign_player_ids(db, df):
     log('finding player ids...', end='')
-    df['fantasy_player_id'] = None
-    for name, sub_df in df.groupby('name'):
-        df.loc[df['name'] == name, 'fantasy_player_id'] = name_to_id(db, sub_df['name'].iloc[0])
+    df['fantasy_player_id'] = df['name'].map(names_to_ids(db, df['name'].unique()))
+    instrument.add_rows(len(df))
     log('done')
 
 
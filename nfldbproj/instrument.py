@@ -0,0 +1,219 @@
+"""
+Timing and statement counts for the stages of an import.
+
+The import functions run their work in named stages
+(`insert_data`, `insert_dataframes`, `insert_metadata`, `insert_projection_sets`,
+`lock_tables`, `lock_data`, `assign_gsis_ids` and `assign_player_ids`).
+When a stage finishes, each hook added with `add_hook` is called with its `StageRecord`:
+its wall time, the time spent waiting for locks, the statements executed and the rows written.
+Stages can be nested, in which case the outer stage's figures include the inner stage's.
+Nothing is recorded while no hooks are added.
+
+`Recorder` is a hook that keeps the records,
+and exports them as dictionaries or in the Prometheus text format:
+
+    with nfldbproj.instrument.recording() as recorder:
+        nfldbproj.import_.from_dataframe(db, df, metadata)
+    print(recorder.prometheus())
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+from psycopg2.extras import RealDictCursor
+
+StageRecord = namedtuple('StageRecord', ['stage', 'labels', 'start', 'wall_time', 'lock_wait',
+                                         'statements', 'rows', 'thread', 'failed'])
+"""
+The measurements of one run of a stage:
+`start` is a Unix time; `wall_time` and `lock_wait` are in seconds;
+`statements` counts the statements and `COPY`s executed by `Cursor`s in the stage's thread;
+`rows` counts the rows written (or for the `assign_` stages, the rows assigned ids);
+and `failed` is true if the stage raised an exception.
+"""
+
+_hooks = []
+_hooks_lock = threading.Lock()
+# The stages running in each thread, innermost last.
+_local = threading.local()
+
+
+class Cursor(RealDictCursor):
+    """A `RealDictCursor` that counts the statements it executes towards the running stages."""
+    def execute(self, query, vars=None):
+        _count_statement()
+        return super(Cursor, self).execute(query, vars)
+
+    def copy_expert(self, sql, file, size=8192):
+        _count_statement()
+        return super(Cursor, self).copy_expert(sql, file, size)
+
+
+class _Stage(object):
+    __slots__ = ('statements', 'rows', 'lock_wait')
+
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+        self.lock_wait = 0
+
+
+def add_hook(hook):
+    """Call `hook` with the `StageRecord` of every stage that finishes from now on, in any thread."""
+    with _hooks_lock:
+        _hooks.append(hook)
+
+
+def remove_hook(hook):
+    with _hooks_lock:
+        _hooks.remove(hook)
+
+
+@contextmanager
+def stage(name, lock=False, **labels):
+    """
+    Run the body as the stage `name`, with `labels` added to its record.
+    If `lock` is true, the stage's wall time is counted as lock wait, in it and every stage enclosing it.
+
+    """
+    if not _hooks:
+        yield
+        return
+
+    stages = _stages()
+    current = _Stage()
+    stages.append(current)
+    start = time.time()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        wall_time = time.time() - start
+        stages.pop()
+        if lock:
+            current.lock_wait = wall_time
+            for enclosing in stages:
+                enclosing.lock_wait += wall_time
+        record = StageRecord(name, labels, start, wall_time, current.lock_wait, current.statements, current.rows,
+                             threading.current_thread().name, failed)
+        for hook in list(_hooks):
+            hook(record)
+
+
+def staged(name, lock=False):
+    """Decorate a function to run as the stage `name` (see `stage`)."""
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name, lock=lock):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def add_rows(n):
+    """Count `n` rows written towards the running stages of this thread."""
+    for running in _stages():
+        running.rows += n
+
+
+def _count_statement():
+    for running in _stages():
+        running.statements += 1
+
+
+def _stages():
+    try:
+        return _local.stages
+    except AttributeError:
+        _local.stages = []
+        return _local.stages
+
+
+class Recorder(object):
+    """A hook keeping the `StageRecord`s it is called with."""
+    def __init__(self):
+        self._records = []
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        with self._lock:
+            self._records.append(record)
+
+    def __len__(self):
+        return len(self._records)
+
+    def clear(self):
+        with self._lock:
+            del self._records[:]
+
+    def records(self):
+        """Return the records as a list of dictionaries, in the order the stages finished."""
+        with self._lock:
+            return [record._asdict() for record in self._records]
+
+    def totals(self):
+        """
+        Return a dictionary mapping each `(stage, labels)` pair (with labels as a sorted tuple of items)
+        to a dictionary of its number of `calls` and its total `wall_time`, `lock_wait`, `statements` and `rows`.
+
+        """
+        totals = OrderedDict()
+        with self._lock:
+            for record in self._records:
+                key = (record.stage, tuple(sorted(record.labels.items())))
+                total = totals.setdefault(key, OrderedDict.fromkeys(['calls'] + _TOTALED_FIELDS, 0))
+                total['calls'] += 1
+                for field in _TOTALED_FIELDS:
+                    total[field] += getattr(record, field)
+        return totals
+
+    def prometheus(self, prefix='nfldbproj_stage'):
+        """Return the totals of each stage in the Prometheus text exposition format."""
+        totals = self.totals()
+        lines = []
+        for field, suffix, description in _PROMETHEUS_METRICS:
+            metric = '{}_{}'.format(prefix, suffix)
+            lines.append('# HELP {} {}'.format(metric, description))
+            lines.append('# TYPE {} counter'.format(metric))
+            for (name, labels), total in totals.items():
+                lines.append('{}{{{}}} {}'.format(metric, ','.join(
+                    '{}="{}"'.format(key, _escape(value)) for key, value in (('stage', name),) + labels
+                ), total[field]))
+        return '\n'.join(lines) + '\n'
+
+
+_TOTALED_FIELDS = ['wall_time', 'lock_wait', 'statements', 'rows']
+_PROMETHEUS_METRICS = [
+    ('calls', 'calls_total', 'Number of times the stage ran.'),
+    ('wall_time', 'seconds_total', 'Wall time spent in the stage.'),
+    ('lock_wait', 'lock_wait_seconds_total', 'Time spent in the stage waiting for locks.'),
+    ('statements', 'statements_total', 'Statements executed in the stage.'),
+    ('rows', 'rows_total', 'Rows written in the stage.'),
+]
+
+
+@contextmanager
+def recording():
+    """Add a new `Recorder` as a hook for the duration, yielding it."""
+    recorder = Recorder()
+    add_hook(recorder)
+    try:
+        yield recorder
+    finally:
+        remove_hook(recorder)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
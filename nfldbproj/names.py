@@ -1,12 +1,152 @@
 """Player name handling."""
 from __future__ import absolute_import, division, print_function
 
-from nfldb import Tx, player_search
+import json
+import os
+import threading
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+from nfldb import Tx
 from nfldb.update import log
 
+from nfldbproj.db import nfldbproj_api_version
+from nfldbproj import instrument
+from nfldbproj.trigram import player_index
 from nfldbproj.update import lock_tables, error
 
-DEFAULT_SEARCH_LIMIT = 5
+DEFAULT_CACHE_SIZE = 10000
+
+
+class NameCache(object):
+    """
+    A least-recently-used cache mapping names to `fantasy_player_id`s, separately for each database.
+
+    If `path` is given, the cache is loaded from that file and saved back to it with `NameCache.save`.
+    A cache file written for a different nfldbproj schema version is ignored.
+
+    The names of each database are stamped with a digest of its `name_disambiguation` table.
+    The first time a database is looked up, the digest is read again (with one query),
+    and if the table has changed (by any process) the database's names are dropped.
+    """
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self._ids = OrderedDict()  # Keyed by (dsn, name), least recently used first.
+        self._markers = {}  # Digests of name_disambiguation by dsn, as of when the names were resolved.
+        self._checked = set()  # The dsns whose digests have been compared with the database.
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def get_many(self, db, names):
+        """Return a dictionary mapping those of `names` that are cached to their ids."""
+        if db.dsn not in self._checked:
+            self._check(db)
+        found = {}
+        with self._lock:
+            for name in names:
+                key = (db.dsn, name)
+                if key in self._ids:
+                    found[name] = self._ids[key] = self._ids.pop(key)
+        return found
+
+    def put_many(self, db, ids_by_names):
+        """Cache a dictionary mapping names to ids, evicting the least recently used names if necessary."""
+        with self._lock:
+            for name, fantasy_player_id in ids_by_names.items():
+                key = (db.dsn, name)
+                self._ids.pop(key, None)
+                self._ids[key] = fantasy_player_id
+            while len(self._ids) > self.maxsize:
+                self._ids.popitem(last=False)
+
+    def discard(self, db, names):
+        """Remove `names` from the cache (without saving it)."""
+        with self._lock:
+            for name in names:
+                self._ids.pop((db.dsn, name), None)
+
+    def disambiguations_changed(self, db, names, old_marker, new_marker):
+        """
+        Record that the `name_disambiguation` rows of `names` were written,
+        changing the table's digest from `old_marker` to `new_marker` (see `_disambiguation_marker`),
+        and save the cache.
+        The names are removed, as are all the database's names if they were resolved under another digest.
+        """
+        with self._lock:
+            if self._markers.get(db.dsn) != old_marker:
+                self._drop(db.dsn)
+            for name in names:
+                self._ids.pop((db.dsn, name), None)
+            self._markers[db.dsn] = new_marker
+            self._checked.add(db.dsn)
+        self.save()
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+    def load(self):
+        with open(self.path) as f:
+            contents = json.load(f)
+        if contents.get('nfldbproj_version') != nfldbproj_api_version:
+            return
+        with self._lock:
+            markers = contents.get('disambiguation_markers', {})
+            self._markers.update(markers)
+            self._checked.difference_update(markers)
+            for dsn, name, fantasy_player_id in contents['ids'][-self.maxsize:]:
+                self._ids[(dsn, name)] = fantasy_player_id
+
+    def save(self):
+        """Write the cache to `path` (if set), replacing the file atomically."""
+        if not self.path:
+            return
+        with self._lock:
+            contents = {
+                'nfldbproj_version': nfldbproj_api_version,
+                'disambiguation_markers': dict(self._markers),
+                'ids': [[dsn, name, fantasy_player_id] for (dsn, name), fantasy_player_id in self._ids.items()],
+            }
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as f:
+            json.dump(contents, f)
+        os.rename(tmp_path, self.path)
+
+    def _check(self, db):
+        """Drop the names of `db` if its `name_disambiguation` table has changed since they were resolved."""
+        with Tx(db, factory=instrument.Cursor) as c:
+            marker = _disambiguation_marker(c)
+        with self._lock:
+            if self._markers.get(db.dsn) != marker:
+                self._drop(db.dsn)
+            self._markers[db.dsn] = marker
+            self._checked.add(db.dsn)
+
+    def _drop(self, dsn):
+        for key in [key for key in self._ids if key[0] == dsn]:
+            del self._ids[key]
+
+
+name_cache = NameCache()
+"""The cache used by `name_to_id` and `names_to_ids`. Replace it with `set_name_cache`."""
+
+
+def set_name_cache(maxsize=DEFAULT_CACHE_SIZE, path=None):
+    """
+    Replace the name cache with a new `NameCache`,
+    e.g. to persist resolved names to `path` between runs.
+    """
+    global name_cache
+    name_cache = NameCache(maxsize=maxsize, path=path)
+    return name_cache
 
 
 def add_alias(db, alias, correct_name):
@@ -26,27 +166,70 @@ def add_name_disambiguations(db, ids_by_names):
     log('Writing rows to name_disambiguation...')
     with Tx(db) as c:
         lock_tables(c, ['name_disambiguation'])
+        old_marker = _disambiguation_marker(c)
         c.execute('INSERT INTO name_disambiguation (name_as_scraped, fantasy_player_id) VALUES '
                   + ', '.join(c.mogrify('(%s, %s)', item) for item in ids_by_names.items()))
+        new_marker = _disambiguation_marker(c)
+    name_cache.disambiguations_changed(db, ids_by_names, old_marker, new_marker)
     log('done.')
 
 
 def name_to_id(db, full_name, **kwargs):
     """
     Find an id for `full_name`,
-    checking first the `name_disambiguation` table and then the `player` table.
-    Optional keyword arguments are passed to `nfldb.player_search`.
+    checking first `name_cache`, then the `name_disambiguation` table and then the `player` table.
+    Optional keyword arguments are passed to `nfldbproj.trigram.PlayerIndex.search`.
 
     If not found, a similarity table is printed and `KeyError` raised.
     """
-    return disambiguate_from_table(db, full_name) or match_or_raise(db, full_name, **kwargs)
+    cached = name_cache.get_many(db, [full_name])
+    if cached:
+        return cached[full_name]
+
+    fantasy_player_id = disambiguate_from_table(db, full_name) or match_or_raise(db, full_name, **kwargs)
+    name_cache.put_many(db, {full_name: fantasy_player_id})
+    return fantasy_player_id
+
+
+def names_to_ids(db, full_names, **kwargs):
+    """
+    Find ids for all of `full_names`, returning a dictionary mapping each name to its id.
+    Names are first looked up in `name_cache`. The rest are looked up in the
+    `name_disambiguation` table with a single query,
+    and only those not found there are searched for in the `player` table.
+    Optional keyword arguments are passed to `nfldbproj.trigram.PlayerIndex.search`.
+
+    If any names are not found, a similarity table is printed for each
+    and `KeyError` is raised listing all of them.
+    """
+    full_names = set(full_names)
+    ids = name_cache.get_many(db, full_names)
+    if len(ids) == len(full_names):
+        return ids
+
+    new_ids = disambiguate_all_from_table(db, full_names - set(ids))
+    not_found = []
+    for full_name in sorted(full_names - set(ids) - set(new_ids)):
+        player_id = _match(db, full_name, **kwargs)
+        if player_id is None:
+            not_found.append(full_name)
+        else:
+            new_ids[full_name] = player_id
+
+    name_cache.put_many(db, new_ids)
+    name_cache.save()
+    if not_found:
+        raise KeyError('{} (see messages above traceback)'.format(', '.join(not_found)))
+
+    ids.update(new_ids)
+    return ids
 
 
 def disambiguate_from_table(db, full_name):
     """
     Lookup `full_name` in `name_disambiguation` table, returning `fantasy_player_id` if found.
     """
-    with Tx(db) as c:
+    with Tx(db, factory=instrument.Cursor) as c:
         c.execute('SELECT fantasy_player_id FROM name_disambiguation WHERE name_as_scraped = %s',
                   (full_name,))
         result = c.fetchone()
@@ -54,19 +237,50 @@ def disambiguate_from_table(db, full_name):
             return result['fantasy_player_id']
 
 
+def disambiguate_all_from_table(db, full_names):
+    """
+    Lookup all of `full_names` in `name_disambiguation` table with a single query,
+    returning a dictionary mapping the names found to their `fantasy_player_id`.
+    """
+    with Tx(db, factory=instrument.Cursor) as c:
+        c.execute('SELECT name_as_scraped, fantasy_player_id FROM name_disambiguation '
+                  'WHERE name_as_scraped = ANY(%s)',
+                  (list(full_names),))
+        return {result['name_as_scraped']: result['fantasy_player_id'] for result in c.fetchall()}
+
+
+def _disambiguation_marker(cursor):
+    """Return a digest of the contents of `name_disambiguation`, which changes whenever a row is written."""
+    cursor.execute('''
+        SELECT md5(coalesce(string_agg(name_as_scraped || E'\\t' || fantasy_player_id, E'\\n'
+                                       ORDER BY name_as_scraped), '')) AS marker
+          FROM name_disambiguation
+    ''')
+    return cursor.fetchone()['marker']
+
+
 def match_or_raise(db, full_name, **kwargs):
     """
     Lookup `full_name` in `player` table.
     If not found, print similarity table and raise `KeyError`.
     Otherwise, return the `player_id`.
-    Optional keyword arguments are passed to `nfldb.player_search`.
+    Optional keyword arguments are passed to `nfldbproj.trigram.PlayerIndex.search`.
+    """
+    player_id = _match(db, full_name, **kwargs)
+    if player_id is None:
+        raise KeyError('{} (see message above traceback)'.format(full_name))
+    return player_id
+
+
+def _match(db, full_name, **kwargs):
+    """
+    Lookup `full_name` in `player` table, returning the `player_id` if found.
+    Otherwise, print similarity table and return `None`.
     """
-    kwargs['limit'] = kwargs.get('limit', DEFAULT_SEARCH_LIMIT)
-    matches = player_search(db, full_name, **kwargs)
+    matches = player_index(db).search(full_name, **kwargs)
 
-    best_match, distance = matches[0]
-    if not distance:
-        return best_match.player_id
+    if matches and matches[0][1] == 1:
+        return matches[0][0].player_id
 
     error("""\
 Player "{}" not found. Closest matches:
@@ -74,7 +288,6 @@ Player "{}" not found. Closest matches:
 Use nfldbproj.add_name_disambiguations to insert correct player_id into the database.""".format(
         full_name, _similarity_search_table(matches)
         ))
-    raise KeyError('{} (see message above traceback)'.format(full_name))
 
 
 def _similarity_search_table(matches):
@@ -0,0 +1,437 @@
+"""
+Functions for building daily-fantasy lineups from stored salaries and projections.
+
+`optimize` finds the lineups with the most projected points under a salary cap exactly.
+Each way of filling the composite (e.g. FLEX) slots with fantasy positions is searched separately:
+
+1. Players are dropped if enough players of the same position are at least as cheap and as highly projected
+   that they could never be in one of the lineups sought.
+2. The most points attainable by each position within every budget is computed by dynamic programming,
+   giving an upper bound on the points of the best lineup including any player or combination of players.
+3. Starting from the best attainable total, a threshold is lowered until enough lineups reach it.
+   For each threshold, the combinations of players that could reach it are enumerated with NumPy,
+   and lineups are built position by position, discarding partial lineups that cannot reach it.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import heapq
+from itertools import chain, combinations, combinations_with_replacement, product
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+import numpy as np
+import pandas as pd
+from psycopg2.extensions import cursor as tuple_cursor
+
+from nfldb import Tx
+
+from nfldbproj.query import _frame
+from nfldbproj.types import player_pos_by_fantasy_pos, composite_fantasy_positions
+
+DEFAULT_ROSTER = OrderedDict([
+    ('QB', 1),
+    ('RB', 2),
+    ('WR', 3),
+    ('TE', 1),
+    ('FLEX', 1),
+    ('DST', 1),
+])
+"""The number of players in each roster slot, as on DraftKings' classic contests."""
+
+DEFAULT_SALARY_CAP = 50000
+
+# Partial lineups are extended in chunks of at most this many candidates, to bound memory use.
+_CHUNK_SIZE = 2 ** 21
+# Combinations are pruned in blocks of this many before being checked one at a time. See `_pareto`.
+_PARETO_BLOCK_SIZE = 1024
+# Bounds are computed over at most this many budget units. See `_budget_unit`.
+_MAX_BUDGET_UNITS = 500
+
+
+def load_slate(db, fpsys, dfs, season_year, week, season_type='Regular', source=None, teams=None):
+    """
+    Return a DataFrame of the players with a salary on DFS site `dfs` (under fantasy-point system `fpsys`)
+    in a week, with columns `fantasy_player_id`, `name`, `team`, `fantasy_pos`, `salary`,
+    `projected_fp` and `fp_variance`.
+
+    Projections are taken from the latest projection set of `source`,
+    or if `source` is `None`, from the mean of the consensus (`fp_consensus`),
+    whose variance is that between sources.
+    Players without a projection are omitted.
+    Pass a list of `teams` to restrict the slate to their players.
+
+    """
+    params = {'fpsys': fpsys, 'dfs': dfs, 'season_year': season_year, 'season_type': season_type,
+              'week': week, 'source': source, 'teams': teams}
+    if source is None:
+        projections = '''
+            SELECT fantasy_player_id, team, fantasy_pos, mean_fp AS projected_fp, stdev_fp ^ 2 AS fp_variance
+              FROM fp_consensus
+              WHERE fpsys_name = %(fpsys)s AND season_year = %(season_year)s
+                AND season_type = %(season_type)s AND week = %(week)s
+        '''
+    else:
+        projections = '''
+            SELECT p.fantasy_player_id, p.team, p.fantasy_pos, p.projected_fp, p.fp_variance
+              FROM (
+                  SELECT source_name, fpsys_name, set_id, season_year FROM projection_set
+                    WHERE source_name = %(source)s AND fpsys_name = %(fpsys)s AND projection_scope = 'week'
+                      AND season_year = %(season_year)s AND season_type = %(season_type)s AND week = %(week)s
+                    ORDER BY date_accessed DESC, set_id DESC
+                    LIMIT 1
+              ) AS s
+              JOIN fp_projection AS p USING (source_name, fpsys_name, set_id, season_year)
+              -- Restricts the partitions of fp_projection scanned, which the join alone does not at plan time.
+              WHERE p.season_year = %(season_year)s
+        '''
+
+    with Tx(db, factory=tuple_cursor) as c:
+        c.execute('''
+            SELECT d.fantasy_player_id, COALESCE(pl.full_name, f.dst_team) AS name,
+                   p.team, p.fantasy_pos::text AS fantasy_pos, d.salary, p.projected_fp, p.fp_variance
+              FROM dfs_salary AS d
+              JOIN ({}) AS p ON p.fantasy_player_id = d.fantasy_player_id
+              JOIN fantasy_player AS f ON f.fantasy_player_id = d.fantasy_player_id
+              LEFT JOIN player AS pl ON pl.player_id = f.player_id
+              WHERE d.fpsys_name = %(fpsys)s AND d.dfs_name = %(dfs)s AND d.season_year = %(season_year)s
+                AND d.season_type = %(season_type)s AND d.week = %(week)s
+                {}
+              ORDER BY p.fantasy_pos, d.salary DESC
+        '''.format(projections, 'AND p.team = ANY(%(teams)s)' if teams is not None else ''), params)
+        return _frame(c)
+
+
+def optimize(players, n_lineups=1, roster=DEFAULT_ROSTER, salary_cap=DEFAULT_SALARY_CAP):
+    """
+    Return the `n_lineups` distinct lineups with the most total `projected_fp`
+    whose total `salary` is at most `salary_cap`, best first.
+
+    `players` is a DataFrame with at least the columns `fantasy_pos`, `salary` and `projected_fp`,
+    such as that returned by `load_slate`; players missing either number are ignored.
+    `roster` maps each roster slot, a fantasy position or one of `types.composite_fantasy_positions`,
+    to its number of players.
+
+    Returns a DataFrame with a row per player in each lineup, in roster order,
+    with the columns `lineup` (numbered from 0), `slot`, and those of `players`.
+    Lineups with equal totals are returned in no particular order.
+
+    """
+    players = players.dropna(subset=['salary', 'projected_fp']).reset_index(drop=True)
+    positions = np.array([getattr(pos, 'name', pos) for pos in players['fantasy_pos']], dtype=object)
+    salary = players['salary'].values.astype(np.int64)
+    points = players['projected_fp'].values.astype(float)
+    slots = [slot for slot, count in roster.items() for _ in range(count)]
+
+    searches = [_Search(counts, labels, positions, salary, points, salary_cap, n_lineups)
+                for counts, labels in _position_counts(roster)]
+    searches = [search for search in searches if search.best > -np.inf]
+    if not searches:
+        return pd.DataFrame(columns=['lineup', 'slot'] + list(players.columns))
+
+    best = max(search.best for search in searches)
+    floor = min(search.floor for search in searches)
+    delta = 1.0
+    while True:
+        threshold = best - delta
+        if threshold < floor:
+            threshold = -np.inf
+        found = [search.lineups(threshold) for search in searches]
+        if threshold == -np.inf or sum(len(lineup_points) for _, lineup_points, _ in found) >= n_lineups:
+            break
+        delta *= 2
+
+    # Put each search's lineups in roster order, then pick the best among all searches.
+    members = np.concatenate([
+        lineup_members[:, _slot_order(labels, slots)] for lineup_members, _, labels in found
+    ])
+    totals = np.concatenate([lineup_points for _, lineup_points, _ in found])
+    chosen = np.argsort(-totals, kind='mergesort')[:n_lineups]
+
+    lineups = players.iloc[members[chosen].ravel()].reset_index(drop=True)
+    lineups.insert(0, 'slot', np.tile(slots, len(chosen)))
+    lineups.insert(0, 'lineup', np.repeat(np.arange(len(chosen)), len(slots)))
+    return lineups
+
+
+def _position_counts(roster):
+    """
+    Generate the ways of filling the slots of `roster` with fantasy positions,
+    as pairs of a dictionary of the number of players of each position
+    and a dictionary of the composite slots filled by each position.
+
+    """
+    counts = OrderedDict()
+    composites = []
+    for slot, count in roster.items():
+        if slot in player_pos_by_fantasy_pos:
+            counts[slot] = counts.get(slot, 0) + count
+        elif slot in composite_fantasy_positions:
+            composites.append([
+                (slot, choice)
+                for choice in combinations_with_replacement(sorted(composite_fantasy_positions[slot]), count)
+            ])
+        else:
+            raise ValueError('Unknown roster slot {}'.format(slot))
+
+    for assignment in product(*composites):
+        config = counts.copy()
+        labels = OrderedDict((pos, [pos] * count) for pos, count in counts.items())
+        for slot, choice in assignment:
+            for pos in choice:
+                config[pos] = config.get(pos, 0) + 1
+                labels.setdefault(pos, []).append(slot)
+        yield config, labels
+
+
+def _slot_order(labels, slots):
+    """Return the permutation putting lineup columns filling the slots `labels` in the order of `slots`."""
+    remaining = list(enumerate(labels))
+    order = []
+    for slot in slots:
+        position = next(j for j, (_, label) in enumerate(remaining) if label == slot)
+        order.append(remaining.pop(position)[0])
+    return order
+
+
+class _Search(object):
+    """
+    The lineups of one way of filling a roster, given by `counts` and `labels` (see `_position_counts`).
+
+    Bounds on the points of lineups are computed over budgets in units of `unit` dollars,
+    with each salary rounded down to a whole number of units, so that they never understate the points attainable.
+    """
+    def __init__(self, counts, labels, positions, salary, points, salary_cap, n_lineups):
+        self.salary = salary
+        self.points = points
+        self.salary_cap = salary_cap
+        self.n_lineups = n_lineups
+        self.labels = labels
+        self.counts = OrderedDict((pos, count) for pos, count in counts.items() if count)
+        self.unit = _budget_unit(salary, salary_cap)
+        budget = salary_cap // self.unit
+
+        self.players = OrderedDict()
+        tables = {}
+        for pos, count in self.counts.items():
+            indices = np.flatnonzero(positions == pos)
+            # Any lineup including a player with `n_lineups + count - 1` players at least as good
+            # can be improved by swapping in one of them, in at least `n_lineups` distinct ways.
+            indices = indices[_undominated(salary[indices], points[indices], n_lineups + count - 1)]
+            indices = indices[salary[indices] <= salary_cap]
+            self.players[pos] = indices
+            tables[pos] = _best_of(salary[indices] // self.unit, points[indices], count, budget)
+
+        # The most points attainable within each budget by the other positions,
+        # and by the other positions and one fewer player of this position.
+        self.others = {}
+        self.one_fewer = {}
+        for pos in self.counts:
+            others = np.zeros(budget + 1)
+            for other in self.counts:
+                if other != pos:
+                    others = _max_plus(others, tables[other][-1])
+            self.others[pos] = others
+            self.one_fewer[pos] = _max_plus(others, tables[pos][-2])
+
+        pos = next(iter(self.counts))
+        self.best = float(_max_plus(self.others[pos], tables[pos][-1])[-1])
+        self.floor = sum(np.sort(points[self.players[pos]])[:count].sum() for pos, count in self.counts.items())
+
+    def lineups(self, threshold):
+        """
+        Return the members (as an array of player indices, one row per lineup) and projected points
+        of every lineup whose projected points are at least `threshold`,
+        and the slot filled by each column of members.
+
+        """
+        # Allow for rounding, as bounds and totals are summed in different orders.
+        threshold -= 1e-9
+        searched = []
+        for pos, count in self.counts.items():
+            indices = self.players[pos]
+            indices = indices[_reaches(
+                self.points[indices] + self._within(self.one_fewer[pos], self.salary_cap - self.salary[indices]),
+                threshold,
+            )]
+            members, pos_salary, pos_points = _combinations(indices, count, self.salary, self.points)
+            keep = _reaches(pos_points + self._within(self.others[pos], self.salary_cap - pos_salary), threshold)
+            members, pos_salary, pos_points = members[keep], pos_salary[keep], pos_points[keep]
+            keep = _pareto(pos_salary, pos_points, self.n_lineups)
+            searched.append(((members[keep], pos_salary[keep], pos_points[keep]), self.labels[pos]))
+
+        # Search the positions with the fewest combinations first, so that partial lineups stay few.
+        searched.sort(key=lambda item: len(item[0][1]))
+        labels = [label for _, pos_labels in searched for label in pos_labels]
+        pos_combinations = [combinations_of_pos for combinations_of_pos, _ in searched]
+        bounds = _completion_bounds(pos_combinations, self.salary_cap)
+
+        members = np.zeros((1, 0), dtype=np.intp)
+        lineup_salary = np.zeros(1, dtype=np.int64)
+        lineup_points = np.zeros(1)
+        for i, (pos_members, pos_salary, pos_points) in enumerate(pos_combinations):
+            if not len(lineup_salary) or not len(pos_salary):
+                return np.zeros((0, len(labels)), dtype=np.intp), np.zeros(0), labels
+            chunk = max(1, _CHUNK_SIZE // len(pos_salary))
+            new_members, new_salary, new_points = [], [], []
+            for start in range(0, len(lineup_salary), chunk):
+                stop = start + chunk
+                total_salary = lineup_salary[start:stop, None] + pos_salary[None, :]
+                total_points = lineup_points[start:stop, None] + pos_points[None, :]
+                rows, columns = np.nonzero(_reaches(
+                    total_points + _bound(bounds[i + 1], self.salary_cap - total_salary), threshold
+                ))
+                new_members.append(np.hstack([members[start + rows], pos_members[columns]]))
+                new_salary.append(total_salary[rows, columns])
+                new_points.append(total_points[rows, columns])
+            members = np.concatenate(new_members)
+            lineup_salary = np.concatenate(new_salary)
+            lineup_points = np.concatenate(new_points)
+        return members, lineup_points, labels
+
+    def _within(self, table, budget):
+        """Look up the points attainable within `budget` (an array of dollars) in a table over budget units."""
+        units = np.minimum(budget // self.unit, len(table) - 1)
+        return np.where(units >= 0, table[np.maximum(units, 0)], -np.inf)
+
+
+def _budget_unit(salary, salary_cap):
+    """
+    Return the budget unit for bounds: the greatest common divisor of the salaries and the cap,
+    or if there would be more than `_MAX_BUDGET_UNITS` of them, the smallest unit with that many.
+
+    """
+    unit = int(np.gcd.reduce(np.append(salary, salary_cap))) or 1
+    return max(unit, -(-salary_cap // _MAX_BUDGET_UNITS))
+
+
+def _best_of(salary, points, count, budget):
+    """
+    Return an array whose `[j, b]` element is the most points of `j` (up to `count`) distinct players
+    with total salary at most `b` (up to `budget`), or -inf if there is no such set,
+    by dynamic programming over the players.
+
+    """
+    best = np.full((count + 1, budget + 1), -np.inf)
+    best[0] = 0
+    for player_salary, player_points in zip(salary, points):
+        if player_salary > budget:
+            continue
+        with_player = best[:-1, :budget + 1 - player_salary] + player_points
+        best[1:, player_salary:] = np.maximum(best[1:, player_salary:], with_player)
+    return best
+
+
+def _max_plus(a, b):
+    """
+    Combine two arrays of the most points attainable within each budget
+    into the most points attainable by both within each budget.
+
+    """
+    spent = np.arange(len(a))[:, None] - np.arange(len(b))[None, :]
+    return (a[None, :] + np.where(spent >= 0, b[np.maximum(spent, 0)], -np.inf)).max(axis=1)
+
+
+def _reaches(bound, threshold):
+    """Return a boolean mask of the finite elements of `bound` at least `threshold`."""
+    return (bound >= threshold) & (bound > -np.inf)
+
+
+def _combinations(indices, count, salary, points):
+    """
+    Return the combinations of `count` of the players `indices`,
+    as an array of player indices (one row per combination), and the total salary and points of each.
+
+    """
+    if len(indices) < count:
+        return np.zeros((0, count), dtype=np.intp), np.zeros(0, dtype=np.int64), np.zeros(0)
+    members = np.fromiter(chain.from_iterable(combinations(indices, count)), dtype=np.intp).reshape(-1, count)
+    return members, salary[members].sum(axis=1), points[members].sum(axis=1)
+
+
+def _undominated(salary, points, limit):
+    """
+    Return a boolean mask of the players dominated by fewer than `limit` others,
+    that is, others with no more salary and no fewer points (ties broken by order).
+
+    """
+    n = len(salary)
+    order = np.arange(n)
+    dominates = ((salary[:, None] <= salary[None, :]) & (points[:, None] >= points[None, :]) &
+                 ((salary[:, None] < salary[None, :]) | (points[:, None] > points[None, :]) |
+                  (order[:, None] < order[None, :])))
+    return dominates.sum(axis=0) < limit
+
+
+def _pareto(salary, points, limit):
+    """
+    Return the sorted indices of the items dominated by fewer than `limit` others,
+    that is, others with no more salary and no fewer points (ties broken by salary order).
+
+    """
+    order = np.lexsort((-points, salary))
+    sorted_points = points[order]
+    if limit == 1:
+        best_before = np.maximum.accumulate(np.r_[-np.inf, sorted_points])[:-1]
+        return np.sort(order[sorted_points > best_before])
+
+    # The `limit`-th most points among the cheaper items only increases,
+    # so items with no more points than its value at the start of their block can be dropped in bulk.
+    candidates = np.ones(len(order), dtype=bool)
+    top = np.zeros(0)
+    for start in range(0, len(order), _PARETO_BLOCK_SIZE):
+        block = sorted_points[start:start + _PARETO_BLOCK_SIZE]
+        if len(top) == limit:
+            candidates[start:start + _PARETO_BLOCK_SIZE] = block > top[0]
+        top = np.concatenate([top, block])
+        if len(top) > limit:
+            top = np.partition(top, len(top) - limit)[-limit:]
+        top.sort()
+
+    # The remaining items are checked exactly, keeping the `limit` most points among cheaper items.
+    # Dropped items never have enough points to be among them.
+    best = []
+    keep = np.zeros(len(order), dtype=bool)
+    for i in np.flatnonzero(candidates):
+        item_points = sorted_points[i]
+        if len(best) < limit:
+            heapq.heappush(best, item_points)
+        elif item_points > best[0]:
+            heapq.heapreplace(best, item_points)
+        else:
+            continue
+        keep[i] = True
+    return np.sort(order[keep])
+
+
+def _completion_bounds(pos_combinations, salary_cap):
+    """
+    Return, for each position `i` of `pos_combinations` (and one past the last),
+    the most points attainable by the positions from `i` on within any budget,
+    as a pair of arrays: budgets (ascending) and the most points attainable within each.
+
+    """
+    bounds = [(np.zeros(1, dtype=np.int64), np.zeros(1))]
+    for _, pos_salary, pos_points in reversed(pos_combinations):
+        frontier = _pareto(pos_salary, pos_points, 1)
+        rest_salary, rest_points = bounds[0]
+        total_salary = (pos_salary[frontier, None] + rest_salary[None, :]).ravel()
+        total_points = (pos_points[frontier, None] + rest_points[None, :]).ravel()
+        affordable = total_salary <= salary_cap
+        total_salary, total_points = total_salary[affordable], total_points[affordable]
+        frontier = _pareto(total_salary, total_points, 1)
+        frontier = frontier[np.argsort(total_salary[frontier], kind='mergesort')]
+        bounds.insert(0, (total_salary[frontier], total_points[frontier]))
+    return bounds
+
+
+def _bound(bound, budget):
+    """Return the most points attainable within `budget` (a number or array) under `bound`, or -inf."""
+    bound_salary, bound_points = bound
+    if not len(bound_salary):
+        return np.full(np.shape(budget), -np.inf)
+    i = np.searchsorted(bound_salary, budget, side='right') - 1
+    return np.where(i >= 0, bound_points[np.maximum(i, 0)], -np.inf)
@@ -0,0 +1,181 @@
+"""
+Functions for reading projections from the nfldbproj tables as pandas DataFrames.
+Each function runs a single SQL statement that does all filtering and column selection,
+and builds its DataFrame a column at a time from the rows of a tuple cursor.
+
+Filter arguments left as `None` are not applied.
+Otherwise they can be a single value or a list of values to match any of.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+import pandas as pd
+from psycopg2.extensions import cursor as tuple_cursor
+
+from nfldb import Tx
+
+from nfldbproj.db import _catalog
+
+_SET_COLUMNS = ['source_name', 'fpsys_name', 'set_id', 'projection_scope',
+                'season_year', 'season_type', 'week', 'date_accessed']
+_ENUM_ARRAY_TYPES = {
+    'season_type': 'season_phase[]',
+    'projection_scope': 'proj_scope[]',
+    'fantasy_pos': 'fantasy_position[]',
+}
+
+
+def fp_projections(db, source=None, fpsys=None, season_year=None, season_type='Regular', week=None,
+                   position=None, player=None, scope='week', latest=True, columns=None):
+    """
+    Return fantasy-point projections (rows of `fp_projection`) as a DataFrame,
+    with the projection-set columns and each player's `name`.
+
+    `source`, `fpsys`, `season_year`, `season_type`, `week` and `scope` (`projection_scope`)
+    filter projection sets, and `position` (`fantasy_pos`) and `player` (`fantasy_player_id`) filter players.
+    If `latest` is true, only the most recently accessed set per source, system and week is used.
+    `columns` restricts the `fp_projection` columns returned.
+
+    """
+    return _projections(db, 'fp_projection', source=source, fpsys=fpsys,
+                        season_year=season_year, season_type=season_type, week=week,
+                        position=position, player=player, scope=scope, latest=latest, columns=columns)
+
+
+def stat_projections(db, source=None, season_year=None, season_type='Regular', week=None,
+                     position=None, player=None, scope='week', latest=True, columns=None):
+    """
+    Return statistical projections (rows of `stat_projection`) as a DataFrame.
+    Arguments are as for `fp_projections`;
+    `columns` can be used to select only the statistical categories of interest.
+
+    """
+    return _projections(db, 'stat_projection', source=source, fpsys='None',
+                        season_year=season_year, season_type=season_type, week=week,
+                        position=position, player=player, scope=scope, latest=latest, columns=columns)
+
+
+def _projections(db, table, source, fpsys, season_year, season_type, week,
+                 position, player, scope, latest, columns):
+    set_filters = OrderedDict([
+        ('source_name', source),
+        ('fpsys_name', fpsys),
+        ('projection_scope', scope),
+        ('season_year', season_year),
+        ('season_type', season_type),
+        ('week', week),
+    ])
+    # Filtering the data table on its partition key too lets the planner skip other seasons' partitions.
+    data_filters = OrderedDict([
+        ('season_year', season_year),
+        ('fantasy_pos', position),
+        ('fantasy_player_id', player),
+    ])
+    set_where, set_params = _where(set_filters, 's')
+    data_where, data_params = _where(data_filters, 'p')
+
+    with Tx(db) as c:
+        catalog = _catalog(c, check_version=True)
+    types = catalog['types'][table]
+    data_columns = [column for column in columns or catalog['columns'][table] if column not in _SET_COLUMNS]
+    unknown = set(data_columns) - set(types)
+    if unknown:
+        raise ValueError('{} has no columns {}'.format(table, ', '.join(sorted(unknown))))
+
+    with Tx(db, factory=tuple_cursor) as c:
+        distinct_on = 'DISTINCT ON (s.source_name, s.fpsys_name, s.season_year, s.season_type, s.week)'
+        c.execute('''
+            WITH sets AS (
+                SELECT {distinct} {set_columns} FROM projection_set AS s
+                  {set_where}
+                  ORDER BY s.source_name, s.fpsys_name, s.season_year, s.season_type, s.week,
+                           s.date_accessed DESC, s.set_id DESC
+            )
+            SELECT {selected_set_columns}, COALESCE(pl.full_name, f.dst_team) AS name, {data_columns}
+              FROM sets AS s
+              JOIN {table} AS p
+                ON (p.source_name, p.fpsys_name, p.set_id, p.season_year)
+                 = (s.source_name, s.fpsys_name, s.set_id, s.season_year)
+              JOIN fantasy_player AS f ON f.fantasy_player_id = p.fantasy_player_id
+              LEFT JOIN player AS pl ON pl.player_id = f.player_id
+              {data_where}
+        '''.format(
+            distinct=distinct_on if latest else '',
+            set_columns=', '.join('s.{}'.format(column) for column in _SET_COLUMNS),
+            set_where=set_where,
+            selected_set_columns=', '.join(_select('s', column) for column in _SET_COLUMNS),
+            data_columns=', '.join(_select('p', column, types[column]) for column in data_columns),
+            table=table,
+            data_where=data_where,
+        ), set_params + data_params)
+        return _frame(c)
+
+
+def _where(filters, alias):
+    """
+    Build a `WHERE` clause matching each column in the dictionary `filters` (on table `alias`)
+    to any of the given values, skipping those that are `None`.
+    Returns the clause and its parameters.
+
+    """
+    clauses = []
+    params = []
+    for column, values in filters.items():
+        if values is None:
+            continue
+        if not isinstance(values, (list, tuple, set, frozenset)):
+            values = [values]
+        clauses.append('{}.{} = ANY(%s{})'.format(
+            alias, column, '::' + _ENUM_ARRAY_TYPES[column] if column in _ENUM_ARRAY_TYPES else ''
+        ))
+        params.append(list(values))
+    return ('WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+
+def _select(alias, column, data_type=None):
+    """Select `column`, casting enumerated types to text so they load as plain strings."""
+    if column in _ENUM_ARRAY_TYPES or data_type == 'USER-DEFINED':
+        return '{0}.{1}::text AS {1}'.format(alias, column)
+    return '{}.{}'.format(alias, column)
+
+
+def _frame(cursor):
+    """Build a DataFrame from the remaining rows of tuple cursor `cursor`, one column at a time."""
+    names = [description[0] for description in cursor.description]
+    rows = cursor.fetchall()
+    columns = zip(*rows) if rows else [()] * len(names)
+    return pd.DataFrame(OrderedDict(zip(names, (list(column) for column in columns))), columns=names)
+
+
+def consensus(db, fpsys=None, season_year=None, season_type='Regular', week=None, position=None, player=None):
+    """
+    Return rows of `fp_consensus` (the mean, median and standard deviation of the latest weekly projection
+    of every source) as a DataFrame, with each player's `name`.
+    Arguments are as for `fp_projections`.
+
+    """
+    where, params = _where(OrderedDict([
+        ('fpsys_name', fpsys),
+        ('season_year', season_year),
+        ('season_type', season_type),
+        ('week', week),
+        ('fantasy_pos', position),
+        ('fantasy_player_id', player),
+    ]), 'p')
+    with Tx(db, factory=tuple_cursor) as c:
+        c.execute('''
+            SELECT p.fpsys_name, p.season_year, p.season_type::text AS season_type, p.week,
+                   p.fantasy_player_id, COALESCE(pl.full_name, f.dst_team) AS name,
+                   p.team, p.fantasy_pos::text AS fantasy_pos,
+                   p.n_sources, p.mean_fp, p.median_fp, p.stdev_fp
+              FROM fp_consensus AS p
+              JOIN fantasy_player AS f ON f.fantasy_player_id = p.fantasy_player_id
+              LEFT JOIN player AS pl ON pl.player_id = f.player_id
+              {}
+        '''.format(where), params)
+        return _frame(c)
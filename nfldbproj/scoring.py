@@ -0,0 +1,215 @@
+"""
+Functions for calculating fantasy points from the statistics collected by nfldb.
+
+The scoring rules of a fantasy-point system are stored in the `fp_scoring_rule` table
+as points per unit of nfldb statistical categories:
+player rules apply to each player's own statistics,
+and DST rules to the totals of all players of a team in a game.
+Bonuses and DST points-allowed tiers are not supported.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+from nfldb import Tx
+from nfldb.types import _player_categories
+from nfldb.update import log
+
+from nfldbproj.db import _catalog
+from nfldbproj.query import _where
+from nfldbproj.types import fantasy_pos_by_player_pos
+from nfldbproj import update
+
+STANDARD_RULES = {
+    'passing_yds': 0.04,
+    'passing_tds': 4,
+    'passing_int': -2,
+    'passing_twoptm': 2,
+    'rushing_yds': 0.1,
+    'rushing_tds': 6,
+    'rushing_twoptm': 2,
+    'receiving_yds': 0.1,
+    'receiving_tds': 6,
+    'receiving_twoptm': 2,
+    'fumbles_lost': -2,
+    'fumbles_rec_tds': 6,
+    'kickret_tds': 6,
+    'puntret_tds': 6,
+    'kicking_xpmade': 1,
+    'kicking_fgm': 3,
+}
+"""Player scoring rules of standard (non-PPR) leagues, with all field goals worth 3 points."""
+
+PPR_RULES = dict(STANDARD_RULES, receiving_rec=1)
+"""Player scoring rules of point-per-reception leagues."""
+
+STANDARD_DST_RULES = {
+    'defense_sk': 1,
+    'defense_int': 2,
+    'defense_frec': 2,
+    'defense_safe': 2,
+    'defense_int_tds': 6,
+    'defense_frec_tds': 6,
+    'defense_misc_tds': 6,
+    'defense_puntblk': 2,
+    'defense_fgblk': 2,
+    'defense_xpblk': 2,
+    'kickret_tds': 6,
+    'puntret_tds': 6,
+}
+"""DST scoring rules of standard leagues, without points-allowed tiers."""
+
+DEFAULT_POSITIONS = ('QB', 'RB', 'WR', 'TE', 'K', 'DST')
+
+
+def set_scoring_rules(db, fpsys_name, rules, dst_rules=None, fpsys_url=None):
+    """
+    Replace the scoring rules of the fantasy-point system `fpsys_name`,
+    adding the system if it doesn't exist.
+    `rules` and `dst_rules` map nfldb statistical categories (e.g. `'passing_yds'`) to points per unit,
+    for players and for DSTs respectively.
+
+    """
+    dst_rules = dst_rules or {}
+    unknown = (set(rules) | set(dst_rules)) - set(_player_categories)
+    if unknown:
+        raise ValueError('Unknown statistical categories {}'.format(', '.join(sorted(unknown))))
+
+    new_metadata = []
+    with Tx(db) as c:
+        catalog = _catalog(c, check_version=True)
+        update._insert_if_new(c, 'fp_system', {'fpsys_name': fpsys_name, 'fpsys_url': fpsys_url}, new_metadata)
+        c.execute('DELETE FROM fp_scoring_rule WHERE fpsys_name = %s', (fpsys_name,))
+        rows = [(fpsys_name, dst, category, points)
+                for dst, category_rules in [(False, rules), (True, dst_rules)]
+                for category, points in sorted(category_rules.items())]
+        if rows:
+            c.execute('INSERT INTO fp_scoring_rule (fpsys_name, dst, category_id, points) VALUES {}'.format(
+                ', '.join(['(%s, %s, %s, %s)'] * len(rows))
+            ), [value for row in rows for value in row])
+    catalog['known'].update(new_metadata)
+
+
+def scoring_rules(db, fpsys_name):
+    """Return the player and DST scoring rules of the fantasy-point system `fpsys_name`, as two dictionaries."""
+    with Tx(db) as c:
+        return _scoring_rules(c, fpsys_name)
+
+
+def _scoring_rules(cursor, fpsys_name):
+    cursor.execute('SELECT dst, category_id, points FROM fp_scoring_rule WHERE fpsys_name = %s', (fpsys_name,))
+    rules, dst_rules = {}, {}
+    for row in cursor.fetchall():
+        (dst_rules if row['dst'] else rules)[row['category_id']] = row['points']
+    return rules, dst_rules
+
+
+def score(db, fpsys_name, season_year, season_type='Regular', week=None, positions=DEFAULT_POSITIONS,
+          locking='advisory'):
+    """
+    Calculate the fantasy points of every player at `positions` and every DST (if `'DST'` is in `positions`)
+    in each game of a season, or of the weeks `week` (a week or list of weeks) only,
+    under the scoring rules of `fpsys_name`, and write them to `fp_score`.
+    The existing scores of `fpsys_name` at `positions` in those games are deleted first, in the same transaction,
+    so players who no longer qualify lose their scores.
+    Returns the number of scores written.
+
+    All scores are calculated from nfldb's `play_player` table with a single `INSERT ... SELECT`.
+    Player positions are mapped to fantasy positions by `nfldbproj.types.fantasy_pos_by_player_pos`;
+    note that nfldb stores each player's current position, not the position at the time of the game.
+    `locking` is one of `nfldbproj.update.LOCKING_MODES`;
+    with `'advisory'` locking, the `fp_score` rows of `fpsys_name` in each week scored are locked
+    by `nfldbproj.update.lock_data`, as they are by an import of that week's scores.
+
+    """
+    if locking not in update.LOCKING_MODES:
+        raise ValueError('locking must be one of {}, not {!r}'.format(', '.join(update.LOCKING_MODES), locking))
+    positions = {getattr(position, 'name', position) for position in positions}
+    player_positions = sorted(player_pos for player_pos, fantasy_pos in fantasy_pos_by_player_pos.items()
+                              if fantasy_pos in positions)
+    where, params = _where(OrderedDict([
+        ('season_year', season_year),
+        ('season_type', season_type),
+        ('week', week),
+    ]), 'g')
+
+    with Tx(db) as c:
+        if locking == 'table':
+            update.lock_tables(c, ['fp_score'])
+        else:
+            c.execute('''
+                SELECT DISTINCT g.season_year, g.season_type::text AS season_type, g.week FROM game AS g {}
+            '''.format(where), params)
+            update.lock_data(c, *[('fp_score', dict(row, fpsys_name=fpsys_name)) for row in c.fetchall()])
+
+        rules, dst_rules = _scoring_rules(c, fpsys_name)
+        if not rules and not dst_rules:
+            raise ValueError('No scoring rules for fantasy-point system {}'.format(fpsys_name))
+
+        selects = []
+        select_params = []
+        if player_positions:
+            selects.append('''
+                SELECT pp.gsis_id, pp.player_id, max(pp.team), {position}, {points}
+                  FROM play_player AS pp
+                  JOIN game AS g ON g.gsis_id = pp.gsis_id
+                  JOIN player AS pl ON pl.player_id = pp.player_id
+                  {where} AND pl.position::text = ANY(%s)
+                  GROUP BY pp.gsis_id, pp.player_id, pl.position
+            '''.format(position=_position_case('pl.position'), points=_points(rules), where=where))
+            select_params.extend(params + [player_positions])
+        if 'DST' in positions:
+            selects.append('''
+                SELECT pp.gsis_id, pp.team, pp.team, 'DST'::fantasy_position, {points}
+                  FROM play_player AS pp
+                  JOIN game AS g ON g.gsis_id = pp.gsis_id
+                  {where} AND pp.team != 'UNK'
+                  GROUP BY pp.gsis_id, pp.team
+            '''.format(points=_points(dst_rules), where=where))
+            select_params.extend(params)
+        if not selects:
+            return 0
+
+        log('scoring {} {} {} for {}...'.format(season_year, season_type, 'all weeks' if week is None else week,
+                                              fpsys_name), end='')
+        c.execute('''
+            DELETE FROM fp_score AS f USING game AS g
+              {} AND g.gsis_id = f.gsis_id AND f.fpsys_name = %s AND f.fantasy_pos::text = ANY(%s)
+        '''.format(where), params + [fpsys_name, sorted(positions)])
+        c.execute('''
+            INSERT INTO fp_score (fpsys_name, gsis_id, fantasy_player_id, team, fantasy_pos, actual_fp)
+              SELECT %s, s.* FROM ({}) AS s
+              -- Rows scored earlier at a fantasy position outside `positions` are not deleted, so are updated.
+              ON CONFLICT (fpsys_name, gsis_id, fantasy_player_id) DO UPDATE
+                SET team = EXCLUDED.team, fantasy_pos = EXCLUDED.fantasy_pos, actual_fp = EXCLUDED.actual_fp
+        '''.format(' UNION ALL '.join(selects)), [fpsys_name] + select_params)
+        log('done.')
+        return c.rowcount
+
+
+def _points(rules):
+    """
+    Return an aggregate expression summing the points of the statistics in `play_player` (aliased `pp`)
+    under `rules`. Points are written as literals, having been checked to be numbers.
+
+    """
+    unknown = set(rules) - set(_player_categories)
+    if unknown:
+        raise ValueError('Unknown statistical categories {}'.format(', '.join(sorted(unknown))))
+    if not rules:
+        return '0::real'
+    return 'sum({})::real'.format(' + '.join(
+        'pp.{} * {!r}'.format(category, float(points)) for category, points in sorted(rules.items())
+    ))
+
+
+def _position_case(column):
+    """Return an expression mapping the nfldb player position `column` to its fantasy position."""
+    return 'CASE {}::text {} END::fantasy_position'.format(column, ' '.join(
+        "WHEN '{}' THEN '{}'".format(player_pos, fantasy_pos)
+        for player_pos, fantasy_pos in sorted(fantasy_pos_by_player_pos.items())
+    ))
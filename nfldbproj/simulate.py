@@ -0,0 +1,277 @@
+"""
+Functions for simulating weekly fantasy-point outcomes from projections.
+
+Each player's points are drawn from a normal distribution
+with mean `projected_fp` and variance `fp_variance`,
+optionally correlated with the other players' (see `nfldbproj.correlation.player_correlations`).
+Outcomes are drawn for all players at once, a batch of simulations at a time,
+and lineup scores are computed from each batch with a single matrix product,
+so memory use is bounded by the batch size rather than the number of simulations.
+Distributions are summarized as they are simulated,
+with percentiles read from fixed-width histograms.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+from collections import namedtuple
+from functools import reduce
+from multiprocessing import Pool
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_PERCENTILES = (5, 25, 50, 75, 95)
+HISTOGRAM_BINS = 2000
+"""The number of bins in the histogram of each distribution, which sets the resolution of percentiles."""
+
+# Histograms span this many standard deviations either side of the mean; outcomes beyond fall in the end bins.
+_HISTOGRAM_SPAN = 6
+# Convergence settings of `_nearest_correlation`.
+_NEAREST_TOLERANCE = 1e-8
+_NEAREST_MAX_ITERATIONS = 200
+
+Simulation = namedtuple('Simulation', ['lineups', 'portfolio'])
+
+
+def sample(players, n_simulations, seed=None, correlation=None, default_variance=0):
+    """
+    Return an array of `n_simulations` simulated outcomes (rows) for each player in the DataFrame `players`
+    (columns), which has columns `projected_fp` and `fp_variance`.
+    `correlation` and `default_variance` are as for `simulate`.
+
+    """
+    mean, sd = _moments(players, default_variance)
+    factor = _factor(correlation)
+    return _outcomes(np.random.RandomState(seed), mean, sd, factor, n_simulations)
+
+
+def simulate(players, lineups=None, n_simulations=10000, batch_size=DEFAULT_BATCH_SIZE, seed=None, processes=1,
+             percentiles=DEFAULT_PERCENTILES, thresholds=(), correlation=None, default_variance=0):
+    """
+    Simulate the scores of `lineups` (a DataFrame with columns `lineup` and `fantasy_player_id`,
+    such as that returned by `nfldbproj.optimize.optimize`) from the outcomes of `players`
+    (a DataFrame with columns `fantasy_player_id`, `projected_fp` and `fp_variance`,
+    such as that returned by `nfldbproj.optimize.load_slate`).
+    If `lineups` is `None`, each player is simulated on its own.
+    `correlation` is a matrix of the correlations between the players, in the order of `players`;
+    if it is not positive semidefinite (as pairwise-complete estimates may not be),
+    the nearest correlation matrix that is (in the Frobenius norm) is used.
+    By default players are independent.
+    Missing variances are replaced by `default_variance`.
+
+    Simulations are run in batches of `batch_size`.
+    If `processes` is greater than 1, they are divided among that many worker processes,
+    each with its own random seed drawn from `seed`.
+    Results are reproducible for the same `seed`, `processes` and `batch_size`.
+
+    Returns a `Simulation` of `lineups`, a DataFrame indexed by lineup (or player) with columns
+    `mean`, `std`, `min`, `max`, a column for each of `percentiles` (e.g. `p50`)
+    and for each of `thresholds`, the probability of scoring at least that much (e.g. `at_least_150`);
+    and `portfolio`, a Series of the same statistics of the best lineup score in each simulation
+    (or `None` if `lineups` is `None`).
+
+    """
+    mean, sd = _moments(players, default_variance)
+    factor = _factor(correlation)
+    if lineups is None:
+        index = pd.Index(players['fantasy_player_id'])
+        weights = np.eye(len(mean))
+    else:
+        index, weights = _lineup_weights(players, lineups)
+
+    # Histograms are centered on the expected scores, so only as many standard deviations as needed are spanned.
+    lineup_mean = mean.dot(weights)
+    scaled = weights * sd[:, None]
+    if factor is None:
+        lineup_sd = np.sqrt((scaled ** 2).sum(axis=0))
+    else:
+        lineup_sd = np.sqrt((factor.T.dot(scaled) ** 2).sum(axis=0))
+    low = lineup_mean - _HISTOGRAM_SPAN * lineup_sd
+    high = lineup_mean + _HISTOGRAM_SPAN * lineup_sd
+    portfolio = lineups is not None
+    if portfolio:
+        low = np.append(low, low.max())
+        high = np.append(high, high.max())
+        lineup_mean = np.append(lineup_mean, lineup_mean.max())
+
+    shards = np.array_split(np.arange(n_simulations), max(1, processes))
+    seeds = np.random.RandomState(seed).randint(0, 2 ** 31 - 1, len(shards))
+    jobs = [(mean, sd, factor, weights, portfolio, _Summary(lineup_mean, low, high, thresholds),
+             len(shard), batch_size, shard_seed)
+            for shard, shard_seed in zip(shards, seeds)]
+    if processes > 1:
+        pool = Pool(processes)
+        try:
+            summaries = pool.map(_simulate_shard, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        summaries = [_simulate_shard(job) for job in jobs]
+
+    stats = reduce(_Summary.merge, summaries).frame(percentiles)
+    if portfolio:
+        return Simulation(stats.iloc[:-1].set_index(index), stats.iloc[-1].rename('portfolio'))
+    return Simulation(stats.set_index(index), None)
+
+
+def _moments(players, default_variance):
+    mean = players['projected_fp'].values.astype(float)
+    variance = players['fp_variance'].fillna(default_variance).values.astype(float)
+    return mean, np.sqrt(np.maximum(variance, 0))
+
+
+def _factor(correlation):
+    """
+    Return a matrix `F` with `F F'` the correlation matrix nearest to `correlation` (see `_nearest_correlation`),
+    or `None` if it is `None`.
+
+    """
+    if correlation is None:
+        return None
+    eigenvalues, eigenvectors = np.linalg.eigh(_nearest_correlation(np.asarray(correlation, dtype=float)))
+    # Rounding leaves eigenvalues slightly below zero and a diagonal slightly off one.
+    factor = eigenvectors * np.sqrt(np.maximum(eigenvalues, 0))
+    norms = np.sqrt((factor ** 2).sum(axis=1))
+    return factor / np.where(norms > 0, norms, 1)[:, None]
+
+
+def _nearest_correlation(matrix, tolerance=_NEAREST_TOLERANCE, max_iterations=_NEAREST_MAX_ITERATIONS):
+    """
+    Return the correlation matrix nearest to the symmetric `matrix` (with `NaN` taken as 0) in the Frobenius norm,
+    by Higham's alternating projections onto the positive semidefinite matrices and those with a unit diagonal,
+    with Dykstra's correction (Higham 2002, "Computing the nearest correlation matrix").
+    A `matrix` that is already a correlation matrix is returned as it is.
+    Iteration stops when an iteration changes the result by less than `tolerance` (relative),
+    or after `max_iterations`.
+
+    """
+    matrix = np.nan_to_num(matrix)
+    if np.allclose(np.diag(matrix), 1) and np.linalg.eigvalsh(matrix).min() >= 0:
+        return matrix
+    result = matrix
+    correction = np.zeros_like(matrix)
+    for _ in range(max_iterations):
+        corrected = result - correction
+        eigenvalues, eigenvectors = np.linalg.eigh(corrected)
+        semidefinite = (eigenvectors * np.maximum(eigenvalues, 0)).dot(eigenvectors.T)
+        correction = semidefinite - corrected
+        previous, result = result, semidefinite.copy()
+        np.fill_diagonal(result, 1)
+        if np.linalg.norm(result - previous) <= tolerance * np.linalg.norm(result):
+            break
+    return result
+
+
+def _outcomes(random_state, mean, sd, factor, n_simulations):
+    deviations = random_state.standard_normal((n_simulations, len(mean)))
+    if factor is not None:
+        deviations = deviations.dot(factor.T)
+    return mean + sd * deviations
+
+
+def _lineup_weights(players, lineups):
+    """
+    Return the lineups in `lineups` as an index and a matrix with a row per player and a column per lineup,
+    counting the times each player is in each lineup.
+
+    """
+    player_index = pd.Index(players['fantasy_player_id']).get_indexer(lineups['fantasy_player_id'])
+    if (player_index < 0).any():
+        raise ValueError('Lineups include players without projections: {}'.format(
+            ', '.join(sorted(set(lineups['fantasy_player_id'][player_index < 0])))
+        ))
+    lineup_ids, lineup_index = np.unique(lineups['lineup'].values, return_inverse=True)
+    weights = np.zeros((len(players), len(lineup_ids)))
+    np.add.at(weights, (player_index, lineup_index), 1)
+    return pd.Index(lineup_ids, name='lineup'), weights
+
+
+def _simulate_shard(job):
+    """Simulate a share of the outcomes, in batches, adding the scores to a `_Summary`. Run by worker processes."""
+    mean, sd, factor, weights, portfolio, summary, n_simulations, batch_size, seed = job
+    random_state = np.random.RandomState(seed)
+    for start in range(0, n_simulations, batch_size):
+        scores = _outcomes(random_state, mean, sd, factor, min(batch_size, n_simulations - start)).dot(weights)
+        if portfolio:
+            scores = np.hstack([scores, scores.max(axis=1)[:, None]])
+        summary.update(scores)
+    return summary
+
+
+class _Summary(object):
+    """
+    Streaming summary statistics and histograms of several distributions (columns of the scores given to `update`).
+    Sums are taken about `center`, the expected value of each distribution, for numerical accuracy,
+    and histograms span `low` to `high`.
+    """
+    def __init__(self, center, low, high, thresholds=()):
+        self.center = center
+        self.low = low
+        self.width = np.maximum(high - low, 1e-9) / HISTOGRAM_BINS
+        self.thresholds = np.asarray(thresholds, dtype=float)
+        self.count = 0
+        self.total = np.zeros(len(center))
+        self.total_squares = np.zeros(len(center))
+        self.minimum = np.full(len(center), np.inf)
+        self.maximum = np.full(len(center), -np.inf)
+        self.histogram = np.zeros((len(center), HISTOGRAM_BINS), dtype=np.int64)
+        self.exceeded = np.zeros((len(center), len(self.thresholds)), dtype=np.int64)
+
+    def update(self, scores):
+        """Add the rows of `scores`, an array with a column per distribution."""
+        deviations = scores - self.center
+        self.count += len(scores)
+        self.total += deviations.sum(axis=0)
+        self.total_squares += (deviations ** 2).sum(axis=0)
+        self.minimum = np.minimum(self.minimum, scores.min(axis=0))
+        self.maximum = np.maximum(self.maximum, scores.max(axis=0))
+
+        bins = np.clip(np.floor((scores - self.low) / self.width), 0, HISTOGRAM_BINS - 1).astype(np.int64)
+        bins += np.arange(scores.shape[1]) * HISTOGRAM_BINS
+        self.histogram += np.bincount(bins.ravel(), minlength=self.histogram.size).reshape(self.histogram.shape)
+        if len(self.thresholds):
+            self.exceeded += (scores[:, :, None] >= self.thresholds).sum(axis=0)
+
+    def merge(self, other):
+        """Add the outcomes summarized by `other`, which must have the same histograms, and return self."""
+        self.count += other.count
+        self.total += other.total
+        self.total_squares += other.total_squares
+        self.minimum = np.minimum(self.minimum, other.minimum)
+        self.maximum = np.maximum(self.maximum, other.maximum)
+        self.histogram += other.histogram
+        self.exceeded += other.exceeded
+        return self
+
+    def frame(self, percentiles):
+        """Return a DataFrame of the statistics of each distribution."""
+        mean_deviation = self.total / self.count
+        variance = np.maximum(self.total_squares / self.count - mean_deviation ** 2, 0)
+        stats = OrderedDict([
+            ('mean', self.center + mean_deviation),
+            ('std', np.sqrt(variance * self.count / max(self.count - 1, 1))),
+            ('min', self.minimum),
+            ('max', self.maximum),
+        ])
+
+        # Interpolate within the bin where the cumulative count reaches each percentile.
+        cumulative = np.cumsum(self.histogram, axis=1)
+        rows = np.arange(len(cumulative))
+        for percentile in percentiles:
+            target = percentile / 100 * self.count
+            i = np.minimum((cumulative < target).sum(axis=1), HISTOGRAM_BINS - 1)
+            before = cumulative[rows, i] - self.histogram[rows, i]
+            fraction = (target - before) / np.maximum(self.histogram[rows, i], 1)
+            value = self.low + (i + fraction) * self.width
+            stats['p{:g}'.format(percentile)] = np.clip(value, self.minimum, self.maximum)
+
+        for j, threshold in enumerate(self.thresholds):
+            stats['at_least_{:g}'.format(threshold)] = self.exceeded[:, j] / self.count
+        return pd.DataFrame(stats)
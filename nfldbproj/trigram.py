@@ -0,0 +1,116 @@
+"""
+An in-memory trigram index over player names, for fuzzy name matching.
+Similarity is computed as in PostgreSQL's pg_trgm extension:
+the number of shared trigrams divided by the number of distinct trigrams in either name.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import heapq
+import re
+from collections import defaultdict, namedtuple
+
+from nfldb import Tx
+
+from nfldbproj import instrument
+
+DEFAULT_SEARCH_LIMIT = 5
+
+# Player indexes by connection DSN. See `player_index`.
+_indexes = {}
+
+
+class IndexedPlayer(namedtuple('IndexedPlayer', ['player_id', 'full_name', 'team', 'position'])):
+    """The fields of an nfldb player needed to match and display its name."""
+    __slots__ = ()
+
+    def __str__(self):
+        return '{} ({}, {})'.format(self.full_name, self.team, self.position)
+
+    def __format__(self, format_spec):
+        return format(str(self), format_spec)
+
+
+class PlayerIndex(object):
+    """
+    Maps each trigram to the players whose names contain it,
+    so that a search only scores the players sharing at least one trigram with the query.
+    """
+    def __init__(self, players):
+        self.players = list(players)
+        self._postings = defaultdict(list)
+        self._sizes = []
+        for i, player in enumerate(self.players):
+            grams = trigrams(player.full_name)
+            self._sizes.append(len(grams))
+            for gram in grams:
+                self._postings[gram].append(i)
+
+    def __len__(self):
+        return len(self.players)
+
+    @classmethod
+    def from_db(cls, db):
+        """Build an index of every player in the `player` table with a single query."""
+        with Tx(db, factory=instrument.Cursor) as c:
+            c.execute('''
+                SELECT player_id, full_name, team, position::text AS position FROM player
+                  WHERE full_name IS NOT NULL
+            ''')
+            return cls(IndexedPlayer(**row) for row in c.fetchall())
+
+    def search(self, full_name, limit=DEFAULT_SEARCH_LIMIT, team=None, position=None):
+        """
+        Return a list of up to `limit` `(player, similarity)` pairs, most similar first,
+        optionally restricted to players on `team` or at `position`.
+        Exact (case- and whitespace-insensitive) matches have similarity 1.
+        """
+        position = getattr(position, 'name', position)
+        grams = trigrams(full_name)
+        shared = defaultdict(int)
+        for gram in grams:
+            for i in self._postings.get(gram, ()):
+                shared[i] += 1
+
+        normalized = _normalize(full_name)
+        scored = []
+        for i, n_shared in shared.items():
+            player = self.players[i]
+            if team is not None and player.team != team:
+                continue
+            if position is not None and player.position != position:
+                continue
+            if _normalize(player.full_name) == normalized:
+                similarity = 1
+            else:
+                # Only exact matches are reported as 1, even if all trigrams are shared.
+                similarity = min(round(n_shared / (len(grams) + self._sizes[i] - n_shared), 3), 0.999)
+            scored.append((similarity, i))
+
+        return [(self.players[i], similarity) for similarity, i in heapq.nlargest(limit, scored)]
+
+
+def player_index(db, refresh=False):
+    """
+    Return the `PlayerIndex` for the database of `db`, building it on first use.
+    Pass `refresh=True` to rebuild it, e.g. after new players have been added by `nfldb-update`.
+    """
+    if refresh or db.dsn not in _indexes:
+        _indexes[db.dsn] = PlayerIndex.from_db(db)
+    return _indexes[db.dsn]
+
+
+def trigrams(name):
+    """
+    Return the set of trigrams of `name`, following pg_trgm:
+    each word is lowercased and padded with two spaces in front and one behind.
+    """
+    grams = set()
+    for word in re.findall(r'[a-z0-9]+', name.lower()):
+        padded = '  {} '.format(word)
+        grams.update(padded[i:i+3] for i in range(len(padded) - 2))
+    return grams
+
+
+def _normalize(name):
+    return ' '.join(name.lower().split())
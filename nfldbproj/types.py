@@ -24,6 +24,11 @@ fantasy_pos_by_player_pos = {player_pos: fantasy_pos
                              for fantasy_pos, player_positions in player_pos_by_fantasy_pos.items()
                              for player_pos in player_positions}
 
+# Roster slots that can be filled by players of any of several fantasy positions.
+composite_fantasy_positions = OrderedDict([
+    ('FLEX', {'RB', 'WR', 'TE'}),
+])
+
 
 class ProjEnums(Enums):
     fantasy_position = _Enum('fantasy_position',
@@ -5,6 +5,7 @@ Currently doesn't use any of nfldb's SQL generation code.
 """
 from __future__ import absolute_import, division, print_function
 
+import csv
 import sys
 from itertools import chain
 
@@ -13,12 +14,19 @@ try:
 except ImportError:
     from ordereddict import OrderedDict
 
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import numpy as np
 from toolz import merge
 
 from nfldb import Tx
 from nfldb.update import log
 
-from nfldbproj.db import nfldbproj_tables
+from nfldbproj.db import nfldbproj_tables, nfldbproj_partitioned_tables, _catalog, _create_partition
+from nfldbproj import instrument
 
 _DATA_TABLES_BY_UNIQUE_FIELD = {
     'salary': 'dfs_salary',
@@ -43,6 +51,36 @@ METADATA_PRIMARY_KEYS = OrderedDict([
 ])
 METADATA_TABLES = list(METADATA_PRIMARY_KEYS.keys())
 
+INSERT_METHODS = ('copy', 'values', 'row')
+"""
+Ways of writing data rows, selectable per call of `insert_data`:
+`'copy'` streams all rows of a table with a single `COPY ... FROM STDIN`,
+`'values'` uses multi-row `INSERT ... VALUES` statements of up to `VALUES_PAGE_SIZE` rows,
+and `'row'` executes one `INSERT` per row.
+"""
+VALUES_PAGE_SIZE = 1000
+
+LOCKING_MODES = ('advisory', 'table')
+"""
+Ways of guarding the writes of `insert_data`, selectable per call:
+`'advisory'` takes a transaction-level advisory lock on the rows of each table and week being written
+(see `lock_data`), so imports of different data can run concurrently;
+`'table'` locks every nfldbproj table for the whole transaction.
+"""
+
+# The metadata identifying the rows of each data table within a week, besides the table itself.
+# Projections are also identified by their set, which only the source writes.
+_LOCK_WRITER_KEYS = {
+    'dfs_salary': ('dfs_name', 'fpsys_name'),
+    'fp_projection': ('source_name', 'fpsys_name'),
+    'fp_score': ('fpsys_name',),
+    'stat_projection': ('source_name', 'fpsys_name'),
+}
+
+_INTEGER_TYPES = {'smallint', 'integer', 'bigint'}
+_COPY_NULL = '\\N'
+_COPY_STATEMENT = "COPY {} ({}) FROM STDIN WITH CSV NULL '\\N'"
+
 
 def warn(*args, **kwargs):
     log('WARNING:', *args, file=sys.stderr, **kwargs)
@@ -52,6 +90,7 @@ def error(*args, **kwargs):
     log('ERROR:', *args, file=sys.stderr, **kwargs)
 
 
+@instrument.staged('lock_tables', lock=True)
 def lock_tables(cursor, tables=frozenset(nfldbproj_tables)):
     log('Locking write access to tables {}...'.format(', '.join(tables)), end='')
     cursor.execute(';\n'.join(
@@ -61,28 +100,366 @@ def lock_tables(cursor, tables=frozenset(nfldbproj_tables)):
     log('done.')
 
 
-def insert_data(db, metadata, data):
+@instrument.staged('lock_data', lock=True)
+def lock_data(cursor, *writes):
+    """
+    Take a transaction-level advisory lock on the rows written by each `(table, metadata)` pair in `writes`,
+    identified by the table, the metadata its rows are keyed by
+    (the fantasy-point system, and the DFS site for `dfs_salary` or the source for projections),
+    and the season and week. A missing `season_type` is taken as `'Regular'`.
+    Writes of other data are not blocked.
+    Locks are taken in a fixed order, so transactions locking overlapping data cannot deadlock.
+
+    """
+    keys = sorted({_lock_key(table, metadata) for table, metadata in writes})
+    log('Locking write access to {}...'.format(', '.join(' '.join(key) for key in keys)), end='')
+    for writer, scope in keys:
+        cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s), hashtext(%s))', (writer, scope))
+    log('done.')
+
+
+def _lock_key(table, metadata):
+    """Return the pair of strings identifying the rows of `table` described by `metadata` (see `lock_data`)."""
+    season_type = metadata.get('season_type') or 'Regular'
+    return (
+        '{}:{}'.format(table, '/'.join(str(metadata.get(key, '')) for key in _LOCK_WRITER_KEYS[table])),
+        '/'.join(str(value) for value in (metadata.get('season_year', ''), getattr(season_type, 'name', season_type),
+                                          metadata.get('week', ''))),
+    )
+
+
+@instrument.staged('insert_data')
+def insert_data(db, metadata, data, method='copy', locking='advisory'):
     """
-    Given a dataset (as an iterable of dictionaries, all with the same keys)
+    Given a dataset (as an iterable of dictionaries)
     and its associated metadata (a dictionary), insert it into the database.
     If any of the metadata items don't exist yet, they will be inserted as well.
 
+    Rows may omit keys whose values are missing; these are stored as NULL.
+    `method` is one of `INSERT_METHODS` and selects how the data rows are written.
+    `locking` is one of `LOCKING_MODES` and selects which locks are taken.
+
+    """
+    _check_options(method, locking)
+
+    rows = list(data)
+    headers = set(chain.from_iterable(rows))
+    tables = _tables_from_headers(headers)
+    create_partitions(db, [(table, metadata.get('season_year')) for table in tables])
+
+    new_metadata = []
+    with Tx(db, factory=instrument.Cursor) as c:
+        catalog = _catalog(c)
+        _lock(c, [(table, metadata) for table in tables], locking)
+        set_id = _insert_metadata(c, metadata, new_metadata)
+
+        row_metadata = metadata if set_id is None else dict(metadata, set_id=set_id)
+        for table in tables:
+            _insert_data_rows(c, table, row_metadata, rows, method=method)
+        if 'fp_projection' in tables:
+            refresh_consensus(c, [metadata])
+    catalog['known'].update(new_metadata)
+
+
+def insert_dataframe(db, metadata, df, method='copy', locking='advisory', tables=None):
+    """
+    Like `insert_data`, but with the dataset given as a pandas DataFrame
+    whose missing values are NaN or `None`.
+    If `tables` is given, only those data tables are written
+    (each taking the columns of `df` it stores);
+    otherwise they are inferred from the columns of `df`.
+
+    The data are handled a column at a time: metadata values are broadcast to whole columns,
+    and with the `'copy'` method the `COPY` input is rendered by `DataFrame.to_csv`,
+    so no Python objects are created per row.
+
+    """
+    insert_dataframes(db, [(metadata, df, tables)], method=method, locking=locking)
+
+
+@instrument.staged('insert_dataframes')
+def insert_dataframes(db, batches, method='copy', locking='advisory', set_ids=None):
+    """
+    Insert several DataFrames in a single transaction.
+    `batches` is an iterable of `(metadata, df, tables)` triples, each written as by `insert_dataframe`.
+    Batches given the same metadata dictionary (not merely an equal one)
+    share its metadata rows and projection set.
+
+    By default a new projection set is created for each metadata dictionary with a `projection_scope`.
+    To add rows to existing projection sets instead, pass `set_ids`,
+    a list giving the `set_id` (or `None` for a new set) of each batch.
+    Returns a list of the `set_id` used by each batch (`None` for batches without a projection set).
+    The metadata dictionaries are not modified.
+
+    """
+    _check_options(method, locking)
+
+    batches = [(metadata, df, tables or _tables_from_headers(df.columns)) for metadata, df, tables in batches]
+    distinct_metadata = list({id(metadata): metadata for metadata, _, _ in batches}.values())
+    set_id_by_metadata = {}
+    for (metadata, _, _), set_id in zip(batches, set_ids or []):
+        if set_id is not None:
+            set_id_by_metadata[id(metadata)] = set_id
+    create_partitions(db, [(table, metadata.get('season_year')) for metadata, _, tables in batches for table in tables])
+
+    new_metadata = []
+    with Tx(db, factory=instrument.Cursor) as c:
+        catalog = _catalog(c)
+        _lock(c, [(table, metadata) for metadata, _, tables in batches for table in tables], locking)
+
+        for metadata in distinct_metadata:
+            _insert_metadata(c, metadata, new_metadata, projection_set=False)
+        new_sets = [metadata for metadata in distinct_metadata
+                    if 'projection_scope' in metadata and id(metadata) not in set_id_by_metadata]
+        if new_sets:
+            for metadata, set_id in zip(new_sets, _insert_projection_sets(c, new_sets)):
+                set_id_by_metadata[id(metadata)] = set_id
+
+        # Frames bound for the same table with the same columns are written together.
+        frames = OrderedDict()
+        projected = []
+        for metadata, df, tables in batches:
+            set_id = set_id_by_metadata.get(id(metadata))
+            frame_metadata = metadata if set_id is None else dict(metadata, set_id=set_id)
+            for table in tables:
+                frame = _table_frame(c, table, frame_metadata, df)
+                if len(frame):
+                    frames.setdefault((table, tuple(frame.columns)), []).append(frame)
+                    if table == 'fp_projection':
+                        projected.append(metadata)
+        for (table, _), table_frames in frames.items():
+            _insert_data_frames(c, table, table_frames, method=method)
+        refresh_consensus(c, projected)
+    catalog['known'].update(new_metadata)
+    return [set_id_by_metadata.get(id(metadata)) for metadata, _, _ in batches]
+
+
+def create_partitions(db, partitions):
+    """
+    Create any missing partitions among the `(table, season_year)` pairs in `partitions`
+    (pairs whose table is not partitioned are ignored), in a transaction of their own,
+    so that the exclusive lock it takes on the parent table is not held while data are written.
+    Partitions known to exist are skipped, leaving only the schema version check of the catalog.
+
+    """
+    with Tx(db, factory=instrument.Cursor) as c:
+        catalog = _catalog(c, check_version=True)
+        missing = sorted({
+            (table, int(season_year)) for table, season_year in partitions
+            if table in nfldbproj_partitioned_tables and season_year is not None
+        } - catalog['partitions'])
+        for table, season_year in missing:
+            log('creating partition of {} for {}...'.format(table, season_year), end='')
+            _create_partition(c, table, season_year)
+            log('done.')
+    catalog['partitions'].update(missing)
+
+
+def refresh_consensus(cursor, metadata):
+    """
+    Recompute the rows of `fp_consensus` for the weeks of the weekly projection sets
+    described by the dictionaries in `metadata`, from each source's most recent projection set.
+    Other weeks are not touched.
+
+    """
+    weeks = sorted({
+        (m['fpsys_name'], m['season_year'], str(m.get('season_type', 'Regular')), m['week'])
+        for m in metadata
+        if getattr(m.get('projection_scope'), 'name', m.get('projection_scope')) == 'week'
+        and m.get('fpsys_name') != 'None'
+    })
+    for fpsys_name, season_year, season_type, week in weeks:
+        log('refreshing fp_consensus for {} {} {} week {}...'.format(fpsys_name, season_year, season_type, week),
+            end='')
+        week_params = {'fpsys_name': fpsys_name, 'season_year': season_year,
+                       'season_type': season_type, 'week': week}
+        # Serialize refreshes of the same week by concurrent imports from different sources.
+        cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s), hashtext(%s))',
+                       ('fp_consensus', '/'.join(str(key) for key in (fpsys_name, season_year, season_type, week))))
+        cursor.execute('''
+            DELETE FROM fp_consensus
+              WHERE fpsys_name = %(fpsys_name)s AND season_year = %(season_year)s
+                AND season_type = %(season_type)s AND week = %(week)s
+        ''', week_params)
+        cursor.execute('''
+            INSERT INTO fp_consensus
+              SELECT p.fpsys_name, s.season_year, s.season_type, s.week, p.fantasy_player_id,
+                     max(p.team), max(p.fantasy_pos), count(*), avg(p.projected_fp),
+                     percentile_cont(0.5) WITHIN GROUP (ORDER BY p.projected_fp), stddev_samp(p.projected_fp)
+              FROM (
+                  SELECT DISTINCT ON (source_name)
+                         source_name, fpsys_name, set_id, season_year, season_type, week
+                    FROM projection_set
+                    WHERE projection_scope = 'week' AND fpsys_name = %(fpsys_name)s
+                      AND season_year = %(season_year)s AND season_type = %(season_type)s AND week = %(week)s
+                    ORDER BY source_name, date_accessed DESC, set_id DESC
+              ) AS s
+              JOIN fp_projection AS p USING (source_name, fpsys_name, set_id, season_year)
+              -- Restricts the partitions of fp_projection scanned, which the join alone does not at plan time.
+              WHERE p.season_year = %(season_year)s
+              GROUP BY p.fpsys_name, s.season_year, s.season_type, s.week, p.fantasy_player_id
+        ''', week_params)
+        log('done.')
+
+
+def _check_options(method, locking):
+    if method not in INSERT_METHODS:
+        raise ValueError('method must be one of {}, not {!r}'.format(', '.join(INSERT_METHODS), method))
+    if locking not in LOCKING_MODES:
+        raise ValueError('locking must be one of {}, not {!r}'.format(', '.join(LOCKING_MODES), locking))
+
+
+def _lock(cursor, writes, locking):
+    if locking == 'table':
+        lock_tables(cursor)
+    else:
+        lock_data(cursor, *writes)
+
+
+def _insert_data_frames(c, table, frames, method='copy'):
+    """Write DataFrames `frames`, as returned by `_table_frame` with identical columns, into `table`."""
+    if method != 'copy':
+        for frame in frames:
+            rows = frame.astype(object).where(frame.notnull(), None).to_dict('records')
+            _insert_data_rows(c, table, {}, rows, method=method)
+        return
+
+    n_rows = sum(len(frame) for frame in frames)
+    log('writing {} rows to {}...'.format(n_rows, table), end='')
+    _copy_frames(c, table, frames)
+    instrument.add_rows(n_rows)
+    log('done.')
+
+
+def _table_frame(c, table, metadata, df):
     """
-    with Tx(db) as c:
-        lock_tables(c)
-        metadata['set_id'] = _insert_metadata(c, metadata)
+    Select the columns of `df` stored in `table`,
+    and add the metadata fields stored in `table` as constant columns.
+    Columns of `df` take precedence over metadata.
+
+    """
+    columns = [column for column in _columns(c, table)
+               if column in df or metadata.get(column) is not None]
+    constants = {column: metadata[column] for column in columns if column not in df}
+    return df[[column for column in columns if column in df]].assign(**constants)[columns]
+
+
+def _copy_frames(cursor, table, frames):
+    """
+    Write DataFrames `frames`, whose columns are the same columns of `table`,
+    with a single `COPY ... FROM STDIN` in CSV format.
+
+    """
+    types = _catalog(cursor)['types'][table]
+    columns = list(frames[0].columns)
+    buf = StringIO()
+    for frame in frames:
+        for column in columns:
+            if types[column] in _INTEGER_TYPES and frame[column].dtype.kind == 'f':
+                # pandas stores integer columns with missing values as floats, which smallint input rejects;
+                # fractional values are rounded as the other methods' are by the server.
+                frame[column] = _integer_strings(frame[column].values)
+        frame.to_csv(buf, header=False, index=False, na_rep=_COPY_NULL)
+    buf.seek(0)
+    statement = _compiled(cursor, ('copy', table, tuple(columns)), lambda: (
+        _COPY_STATEMENT.format(table, ', '.join(columns))
+    ))
+    cursor.copy_expert(statement, buf)
+
+
+def _integer_strings(values):
+    """Format a float array as strings of integers rounded by `_rounded`, with NaN as the `COPY` null marker."""
+    missing = np.isnan(values)
+    strings = _rounded(np.where(missing, 0, values)).astype(np.int64).astype(str).astype(object)
+    strings[missing] = _COPY_NULL
+    return strings
+
+
+def _insert_data_rows(c, table, metadata, data, method='copy'):
+    rows = list(_cleaned_rows(c, table, metadata, data))
+    if not rows:
+        return
+
+    if method == 'row':
+        for row in rows:
+            _insert_dict(c, table, row)
+        instrument.add_rows(len(rows))
+        return
+
+    present = set(chain.from_iterable(rows))
+    columns = [column for column in _columns(c, table) if column in present]
+    log('writing {} rows to {}...'.format(len(rows), table), end='')
+    if method == 'copy':
+        _copy_rows(c, table, columns, rows)
+    else:
+        _insert_rows(c, table, columns, rows)
+    instrument.add_rows(len(rows))
+    log('done.')
+
+
+def _copy_rows(cursor, table, columns, rows):
+    """
+    Write dictionaries `rows` into `table` with a single `COPY ... FROM STDIN` in CSV format.
+    Missing and `None` values are written as NULL.
+
+    """
+    types = _catalog(cursor)['types'][table]
+    integer = [types[column] in _INTEGER_TYPES for column in columns]
+    buf = StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
+    for row in rows:
+        writer.writerow([_copy_value(row.get(column), is_integer) for column, is_integer in zip(columns, integer)])
+    buf.seek(0)
+    statement = _compiled(cursor, ('copy', table, tuple(columns)), lambda: (
+        _COPY_STATEMENT.format(table, ', '.join(columns))
+    ))
+    cursor.copy_expert(statement, buf)
+
+
+def _copy_value(value, integer=False):
+    """
+    Format a single value as a field of `COPY` CSV input.
+    If `integer` is true, the value is bound for an integer column, and floats are rounded as by `_rounded`.
+
+    """
+    if value is None:
+        return _COPY_NULL
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, float):
+        if value != value:
+            return _COPY_NULL
+        # Integer input of COPY must be integral, but the other methods let the server round.
+        if integer or value.is_integer():
+            return str(int(_rounded(value)))
+        return repr(float(value))
+    return value
+
+
+def _rounded(values):
+    """
+    Round a float or array of floats to the nearest integers, with halves away from zero,
+    as the server rounds the numeric parameters written to integer columns by the `'values'` and `'row'` methods.
+
+    """
+    whole = np.trunc(values)
+    return whole + np.where(np.abs(values - whole) >= 0.5, np.sign(values), 0)
 
-        data_iterator = iter(data)
-        first_row = next(data_iterator)
-        headers = list(first_row.keys())
-        for table in _tables_from_headers(headers):
-            _insert_data_rows(c, table, metadata, chain([first_row], data_iterator))
 
+def _insert_rows(cursor, table, columns, rows):
+    """
+    Write dictionaries `rows` into `table` with multi-row `INSERT ... VALUES` statements
+    of at most `VALUES_PAGE_SIZE` rows each.
+    Missing values are written as NULL.
 
-def _insert_data_rows(c, table, metadata, data):
-    # This is not performant (one execute per row) but unless it's slow I don't plan to address that.
-    for row in _cleaned_rows(c, table, metadata, data):
-        _insert_dict(c, table, row)
+    """
+    row_placeholder = '({})'.format(', '.join(['%s'] * len(columns)))
+    for start in range(0, len(rows), VALUES_PAGE_SIZE):
+        page = rows[start:start + VALUES_PAGE_SIZE]
+        statement = _compiled(cursor, ('values', table, tuple(columns), len(page)), lambda: (
+            'INSERT INTO {} ({}) VALUES {}'.format(table, ', '.join(columns), ', '.join([row_placeholder] * len(page)))
+        ))
+        cursor.execute(statement, [row.get(column) for row in page for column in columns])
 
 
 def _cleaned_rows(c, table, metadata, data):
@@ -92,22 +469,26 @@ def _cleaned_rows(c, table, metadata, data):
         yield _subdict(columns, merge(metadata, row))
 
 
-def _insert_metadata(c, metadata):
+@instrument.staged('insert_metadata')
+def _insert_metadata(c, metadata, new_metadata=None, projection_set=True):
     """
     Insert new rows into the tables `fp_system`, `dfs_site`, and `projection_source`,
     using a dictionary `metadata` with keys of column names from those tables.
 
     If a fantasy-point system, DFS site, or projection source specified in `metadata` already exists,
     it is ignored, even if the data conflicts with the existing record (in which case it is NOT updated).
+    The `(table, primary key)` pairs of the rows ensured to exist are appended to the list `new_metadata`;
+    once the transaction commits, the caller should add them to the catalog's `known` set.
 
     Returns the `set_id` that was inserted, if any.
+    Pass `projection_set=False` to leave projection sets to the caller (see `_insert_projection_sets`).
 
     """
     for table in METADATA_TABLES:
         # Special handling for projection_set: don't check primary key existence,
         # because of SERIAL type of set_id.
         if table == 'projection_set':
-            if 'projection_scope' not in metadata:
+            if 'projection_scope' not in metadata or not projection_set:
                 continue
             # Returning is OK here because projection_set should always be the last metadata table inserted into.
             return _extract_and_insert(c, table, metadata, ignore_if_exists=False, returning='set_id')
@@ -122,7 +503,39 @@ def _insert_metadata(c, metadata):
             continue
 
         else:
-            _extract_and_insert(c, table, metadata, ignore_if_exists=True)
+            _extract_and_insert(c, table, metadata, ignore_if_exists=True, new_metadata=new_metadata)
+
+
+@instrument.staged('insert_projection_sets')
+def _insert_projection_sets(cursor, metadatas):
+    """
+    Insert a row into `projection_set` for each dictionary in `metadatas` with a single multi-row `INSERT`,
+    returning the new `set_id`s in the same order.
+    The ids are drawn from the `set_id` sequence beforehand, in one query,
+    because the order of the rows returned by `INSERT ... RETURNING` is not guaranteed.
+
+    """
+    cursor.execute('''
+        SELECT nextval(pg_get_serial_sequence('projection_set', 'set_id')) AS set_id
+          FROM generate_series(1, %s)
+    ''', (len(metadatas),))
+    set_ids = [result['set_id'] for result in cursor.fetchall()]
+
+    columns = _columns(cursor, 'projection_set')
+    rows = [dict(_remove_nones(_subdict(columns, metadata)), set_id=set_id)
+            for metadata, set_id in zip(metadatas, set_ids)]
+    present = [column for column in columns if any(column in row for row in rows)]
+    log('inserting {} new projection_set rows...'.format(len(rows)), end='')
+    cursor.execute(
+        'INSERT INTO projection_set ({}) VALUES {}'.format(', '.join(present), ', '.join(
+            # Columns missing from some rows take their default values.
+            '({})'.format(', '.join('%s' if column in row else 'DEFAULT' for column in present))
+            for row in rows
+        )),
+        [row[column] for row in rows for column in present if column in row]
+    )
+    log('done.')
+    return set_ids
 
 
 def _check_headers(cursor, headers):
@@ -137,7 +550,7 @@ def _extract_and_insert(cursor, table, data, ignore_if_exists=True, **kwargs):
     """
     Insert row into a metadata table `table`
     using only those elements of dictionary `data` that correspond to columns in `table`.
-    Keyword arguments (notably `returning`) are passed to `_insert_dict`.
+    Keyword arguments are passed to `_insert_if_new` or (notably `returning`) `_insert_dict`.
 
     """
     if ignore_if_exists:
@@ -146,19 +559,31 @@ def _extract_and_insert(cursor, table, data, ignore_if_exists=True, **kwargs):
         return _insert_dict(cursor, table, _subdict(_columns(cursor, table), data), **kwargs)
 
 
-def _insert_if_new(cursor, table, data, **kwargs):
+def _insert_if_new(cursor, table, data, new_metadata=None):
     """
-    Check if row specified in dictionary `data` exists in table `table`,
-    and if it doesn't, insert it.
-    Keyword arguments (notably `returning`) are passed to `_insert_dict`.
+    Insert row specified in dictionary `data` into metadata table `table`
+    unless a row with the same primary key exists,
+    using a single `INSERT ... ON CONFLICT DO NOTHING` (which is also safe against concurrent imports).
+    Rows in the catalog's `known` set are skipped without a round trip.
+    If given, `new_metadata` is appended with the `(table, primary key)` pair of the row.
+
+    The `known` set lasts as long as the catalog, so a metadata row deleted by hand
+    is not reinserted by the same process.
 
     """
-    pk_only_data = _subdict(METADATA_PRIMARY_KEYS[table], data, enforce_key_presence=True)
-    if not _exists(cursor, table, pk_only_data):
-        log('inserting new {}...'.format(table), end='')
-        result = _insert_dict(cursor, table, data, **kwargs)
-        log('done.')
-        return result
+    data = dict(_remove_nones(data))
+    pk = (table, tuple(data[key] for key in METADATA_PRIMARY_KEYS[table]))
+    if pk in _catalog(cursor)['known'] or (new_metadata is not None and pk in new_metadata):
+        return
+
+    def compile_statement():
+        return 'INSERT INTO {} ({}) VALUES ({}) ON CONFLICT DO NOTHING'.format(table, *_query_fields(data))
+
+    cursor.execute(_compiled(cursor, ('insert_if_new', table, tuple(data)), compile_statement), data)
+    if cursor.rowcount:
+        log('inserted new {}.'.format(table))
+    if new_metadata is not None:
+        new_metadata.append(pk)
 
 
 def _insert_dict(cursor, table, data, returning=None):
@@ -168,28 +593,34 @@ def _insert_dict(cursor, table, data, returning=None):
 
     """
     data = dict(_remove_nones(data))
-    cols, vals = _query_fields(data)
-    returning_clause = 'RETURNING {}'.format(returning) if returning else ''
-    cursor.execute(
-        'INSERT INTO {} ({}) VALUES ({}) {}'.format(table, cols, vals, returning_clause),
-        data
-    )
+
+    def compile_statement():
+        cols, vals = _query_fields(data)
+        returning_clause = 'RETURNING {}'.format(returning) if returning else ''
+        return 'INSERT INTO {} ({}) VALUES ({}) {}'.format(table, cols, vals, returning_clause)
+
+    statement = _compiled(cursor, ('insert', table, tuple(data), returning), compile_statement)
+    cursor.execute(statement, data)
     if returning:
         return cursor.fetchone()[returning]
 
 
-def _exists(cursor, table, data):
-    """Check if the row specified by dictionary `data` exists in table `table`."""
-    cursor.execute('SELECT 1 FROM {} WHERE ({}) = ({})'.format(table, *_query_fields(data)), data)
-    return bool(cursor.fetchone())
+def _columns(cursor, table):
+    """Return the columns of a table as a list, from the cached schema catalog."""
+    return _catalog(cursor)['columns'][table]
 
 
-def _columns(cursor, table):
-    """Return the columns of a table as a list."""
-    cursor.execute('''
-        SELECT column_name FROM information_schema.columns WHERE table_schema = 'public' AND table_name = %s
-    ''', (table, ))
-    return [column['column_name'] for column in cursor.fetchall()]
+def _compiled(cursor, key, compile_statement):
+    """
+    Return the SQL statement cached under `key` in the schema catalog of `cursor`'s database,
+    calling `compile_statement` to build it on a cache miss.
+    Keys are tuples starting with the kind of statement, the table, and the columns involved.
+
+    """
+    statements = _catalog(cursor)['statements']
+    if key not in statements:
+        statements[key] = compile_statement()
+    return statements[key]
 
 
 def _tables_from_headers(headers):